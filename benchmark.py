@@ -0,0 +1,212 @@
+"""Benchmark end-to-end alur transaksi new.py terhadap stub API lokal dan bill acceptor simulasi.
+
+Alur per transaksi: token dibuat di stub -> (webhook atau polling) -> invoice GET -> EN_PIN aktif ->
+pulsa diputar lewat backend simulasi -> kredit -> settlement POST diterima stub.
+
+Contoh:
+    python benchmark.py --transactions 20 --start webhook --output bench_results.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ["BILL_GPIO_BACKEND"] = "sim"
+os.environ.setdefault("BILL_LOG_DIR", tempfile.mkdtemp(prefix="billacceptor-log-"))
+os.environ.setdefault("BILL_DATA_DIR", tempfile.mkdtemp(prefix="billacceptor-data-"))
+os.environ.setdefault("BILL_WEBHOOK_TOKEN", "benchmark")
+
+import new
+
+class StubBackend:
+    """Stub TOKEN_API / INVOICE_API / BILL_API di memori, mencatat waktu settlement diterima."""
+
+    def __init__(self):
+        self.tokens = []
+        self.invoices = {}
+        self.settlements = {}
+        self.condition = threading.Condition()
+
+    def create_token(self, token, price):
+        created_at = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        with self.condition:
+            self.invoices[token] = {"ID": token, "paymentToken": token, "productPrice": str(price), "isPaid": False}
+            self.tokens.insert(0, {"PaymentToken": token, "CreatedAt": created_at})
+
+    def record_settlement(self, payload):
+        with self.condition:
+            invoice = self.invoices.get(payload.get("paymentToken"))
+            if invoice is not None:
+                invoice["isPaid"] = True
+            self.settlements[payload.get("paymentToken")] = (time.monotonic(), payload)
+            self.condition.notify_all()
+
+    def wait_for_settlement(self, token, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: token in self.settlements, timeout)
+            return self.settlements.get(token)
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/invoice/device/"):
+                with backend.condition:
+                    self.send_json({"data": list(backend.tokens)})
+            elif self.path.startswith("/invoice/"):
+                invoice = backend.invoices.get(self.path.rsplit("/", 1)[-1])
+                if invoice is None:
+                    self.send_json({"error": "Invoice tidak ditemukan"}, 404)
+                else:
+                    self.send_json({"data": invoice})
+            else:
+                self.send_json({"error": "Not found"}, 404)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            backend.record_settlement(payload)
+            self.send_json({"message": "Pembayaran berhasil", "payment date": datetime.datetime.now().isoformat()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def pulse_ticks(pulses, period_us, start_tick):
+    return [(start_tick + i * period_us) & 0xFFFFFFFF for i in range(pulses)]
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+    return {
+        "count": len(ordered),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p90_ms": round(pick(0.90) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2)
+    }
+
+def run_benchmark(args):
+    backend = StubBackend()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(backend))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    new.INVOICE_API = f"{base_url}/invoice/"
+    new.BILL_API = f"{base_url}/order/billacceptor"
+    device = next(iter(new.devices.values()))
+    device.token_api = f"{base_url}/invoice/device/{device.device_id}"
+    pulses = next(note["pulses"] for note in new.load_denominations() if note["nominal"] == args.price)
+
+    new.start_edge_capture()
+    device.start()
+    new.start_background_workers()
+    client = new.app.test_client()
+
+    samples = {"token_to_enable": [], "last_pulse_to_credit": [], "credit_to_settlement": [], "transaction_total": []}
+    failures = 0
+    started = time.monotonic()
+
+    for index in range(args.transactions):
+        token = f"bench-{os.getpid()}-{index}"
+        write_index = len(new.pi.writes)
+
+        token_time = time.monotonic()
+        backend.create_token(token, args.price)
+        if args.start == "webhook":
+            client.post(f"/api/invoice/{device.device_id}", json={"paymentToken": token},
+                        headers={"X-Webhook-Token": new.WEBHOOK_TOKEN})
+
+        enabled = new.pi.wait_for_write(device.en_pin, 1, write_index, timeout=args.step_timeout)
+        if enabled is None:
+            failures += 1
+            continue
+
+        write_index = enabled[0] + 1
+        new.pi.replay(device.pin, pulse_ticks(pulses, args.pulse_period_us, new.pi.get_current_tick()), args.speed or None)
+        last_pulse_time = time.monotonic()
+
+        credited = new.pi.wait_for_write(device.en_pin, 1, write_index, timeout=args.step_timeout)
+        settlement = backend.wait_for_settlement(token, args.step_timeout)
+        if credited is None or settlement is None:
+            failures += 1
+            continue
+
+        samples["token_to_enable"].append(enabled[1] - token_time)
+        samples["last_pulse_to_credit"].append(credited[1] - last_pulse_time)
+        samples["credit_to_settlement"].append(settlement[0] - credited[1])
+        samples["transaction_total"].append(settlement[0] - token_time)
+
+        # Tunggu driver kembali ke WAITING_TOKEN sebelum transaksi berikutnya
+        while device.transaction_active:
+            time.sleep(0.001)
+
+    elapsed = time.monotonic() - started
+    server.shutdown()
+    completed = len(samples["transaction_total"])
+
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "transactions": args.transactions,
+            "start": args.start,
+            "price": args.price,
+            "pulses": pulses,
+            "pulse_period_us": args.pulse_period_us,
+            "speed": args.speed,
+            "settle_time": new.SETTLE_TIME,
+            "train_end": device.train_end_time(),
+            "debounce_time": new.DEBOUNCE_TIME
+        },
+        "completed": completed,
+        "failures": failures,
+        "elapsed_s": round(elapsed, 3),
+        "transactions_per_minute": round(completed / elapsed * 60, 2) if elapsed else 0,
+        "latency": {name: percentiles(values) for name, values in samples.items()},
+        "http": new.http_latency_stats()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end bill acceptor terhadap stub API lokal.")
+    parser.add_argument("--transactions", type=int, default=10)
+    parser.add_argument("--start", choices=("webhook", "poll"), default="webhook", help="cara token sampai ke kiosk")
+    parser.add_argument("--price", type=int, default=5000, help="tagihan per transaksi (harus nominal di tabel denominasi)")
+    parser.add_argument("--pulse-period-us", type=int, default=100000, help="periode pulsa acceptor simulasi")
+    parser.add_argument("--speed", type=float, default=1.0, help="kecepatan replay pulsa (0 = tanpa jeda)")
+    parser.add_argument("--step-timeout", type=float, default=30, help="batas tunggu tiap tahap (detik)")
+    parser.add_argument("--output", default="bench_results.json", help="file hasil JSON")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run_benchmark(args)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Selesai: {results['completed']}/{args.transactions} transaksi, gagal: {results['failures']}")
+    print(f"Transaksi per menit: {results['transactions_per_minute']}")
+    for name, stats in results["latency"].items():
+        if stats:
+            print(f"  {name}: p50 {stats['p50_ms']} ms, p90 {stats['p90_ms']} ms, p99 {stats['p99_ms']} ms, maks {stats['max_ms']} ms")
+    print(f"Hasil ditulis ke {args.output}")
+    return 0 if results["failures"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""Kalibrasi debounce dan periode pulsa per perangkat dari rekaman pulsa.
+
+Rekaman bisa berupa korpus JSON lines replay.py atau ekspor .npy dari /api/debug/edges. Hasil
+disimpan ke CALIBRATION_FILE dan dipakai new.py saat startup jika lolos guard rail. Kalibrasi
+dari trafik live tersedia lewat /api/debug/calibration/<device_id>.
+
+Contoh:
+    python calibrate.py edges-bic01.npy                   # hanya menampilkan hasil
+    python calibrate.py edges-bic01.npy korpus.jsonl --device bic01 --write
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+
+os.environ["BILL_GPIO_BACKEND"] = "sim"
+os.environ.setdefault("BILL_LOG_DIR", tempfile.mkdtemp(prefix="billacceptor-log-"))
+
+import gpio_sim
+import new
+
+def main():
+    parser = argparse.ArgumentParser(description="Kalibrasi timing pulsa bill acceptor dari rekaman.")
+    parser.add_argument("traces", nargs="+", help="korpus JSON lines atau ekspor .npy")
+    parser.add_argument("--device", help="device_id yang dikalibrasi (default: perangkat pertama)")
+    parser.add_argument("--write", action="store_true", help="simpan hasil ke file kalibrasi")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        device = new.find_device(args.device) or next(iter(new.devices.values()))
+
+    # Rangkaian dipecah pada ambang akhir rangkaian perangkat saat ini, bukan SETTLE_TIME
+    train_gap = new.train_end_threshold(device.gap_multiple, device.pulse_gap)
+    trains = [note["ticks"] for path in args.traces for note in gpio_sim.load_trace(path, int(train_gap * 1_000_000))]
+    try:
+        calibration = new.fit_calibration(new.train_intervals(trains, train_gap))
+    except ValueError as e:
+        print(f"Kalibrasi gagal: {e}")
+        return 1
+
+    print(f"Perangkat: {device.device_id}, rangkaian: {len(trains)}, interval: {calibration['samples']}, "
+          f"pantulan: {calibration['bounces']}")
+    print(f"Median interval: {calibration['median_interval'] * 1000:.1f} ms")
+    print(f"Debounce: {device.debounce * 1000:.1f} ms -> {calibration['debounce'] * 1000:.1f} ms")
+    print(f"Periode pulsa (pulse_gap): {device.pulse_gap * 1000:.1f} ms -> {calibration['pulse_gap'] * 1000:.1f} ms")
+
+    reason = new.check_calibration(calibration)
+    if reason is not None:
+        print(f"Ditolak guard rail: {reason}")
+        return 1
+
+    if args.write:
+        new.save_calibration(device.device_id, calibration)
+        print(f"Hasil ditulis ke {new.CALIBRATION_FILE}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
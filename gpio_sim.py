@@ -0,0 +1,168 @@
+"""Backend GPIO simulasi, pengganti modul pigpio untuk pengembangan dan replay tanpa Raspberry Pi.
+
+Diaktifkan di new.py dengan BILL_GPIO_BACKEND=sim. Modul ini menyediakan konstanta dan fungsi
+pigpio yang dipakai new.py, serta kelas pi yang mencatat setiap write ke pin output dan
+meneruskan tepi rekaman (dengan tick aslinya) ke callback yang terdaftar.
+"""
+import ast
+import json
+import struct
+import threading
+import time
+
+INPUT = 0
+OUTPUT = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+NTFY_FLAGS_EVENT = 1 << 7
+NTFY_FLAGS_ALIVE = 1 << 6
+NTFY_FLAGS_WDOG = 1 << 5
+
+class error(Exception):
+    pass
+
+def tickDiff(t1, t2):
+    """Selisih tick (mikrodetik) dengan penanganan wrap 32-bit, sama seperti pigpio.tickDiff."""
+    return (t2 - t1) & 0xFFFFFFFF
+
+class _Callback:
+    def __init__(self, callbacks, entry):
+        self._callbacks = callbacks
+        self._entry = entry
+
+    def cancel(self):
+        if self._entry in self._callbacks:
+            self._callbacks.remove(self._entry)
+
+class pi:
+    """Pengganti pigpio.pi: tidak butuh daemon, mencatat write pin, dan memutar ulang tepi rekaman."""
+
+    def __init__(self, host=None, port=None):
+        self.connected = True
+        self.modes = {}
+        self.levels = {}
+        self.writes = []  # (waktu monotonic, gpio, level)
+        self.callbacks = []  # (gpio, edge, func)
+        self.write_condition = threading.Condition()
+        self.tick_offset = 0  # Dimajukan saat replay tanpa jeda memutar tick di depan jam
+
+    def stop(self):
+        self.connected = False
+
+    def get_current_tick(self):
+        return (int(time.monotonic() * 1_000_000) + self.tick_offset) & 0xFFFFFFFF
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def set_pull_up_down(self, gpio, pud):
+        self.levels[gpio] = 1 if pud == PUD_UP else 0
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        with self.write_condition:
+            self.levels[gpio] = level
+            self.writes.append((time.monotonic(), gpio, level))
+            self.write_condition.notify_all()
+
+    def wait_for_write(self, gpio, level, after_index=0, timeout=None):
+        """Menunggu write gpio=level pada indeks >= after_index; mengembalikan (indeks, waktu) atau None."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.write_condition:
+            while True:
+                for index in range(after_index, len(self.writes)):
+                    write_time, write_gpio, write_level = self.writes[index]
+                    if write_gpio == gpio and write_level == level:
+                        return index, write_time
+                after_index = len(self.writes)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.write_condition.wait(remaining)
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        entry = (gpio, edge, func)
+        self.callbacks.append(entry)
+        return _Callback(self.callbacks, entry)
+
+    def notify_open(self):
+        raise error("pipe notifikasi tidak tersedia pada backend simulasi")
+
+    def inject_edge(self, gpio, tick, level=1):
+        """Meneruskan satu tepi ke callback yang cocok dengan tick aslinya."""
+        self.levels[gpio] = level
+        for cb_gpio, edge, func in list(self.callbacks):
+            if cb_gpio != gpio or func is None:
+                continue
+            if edge == EITHER_EDGE or (edge == RISING_EDGE and level == 1) or (edge == FALLING_EDGE and level == 0):
+                func(gpio, level, tick)
+
+    def replay(self, gpio, ticks, speed=1.0):
+        """Memutar ulang tick tepi naik rekaman; speed=None berarti secepat mungkin tanpa jeda.
+
+        Tick digeser agar tepi pertama jatuh pada tick saat ini (jarak antar tepi tetap), sehingga jeda
+        akhir rangkaian yang diukur dengan get_current_tick tetap bermakna. Tanpa jeda, jam tick simulasi
+        ikut dimajukan ke tepi yang diputar.
+        """
+        if not ticks:
+            return
+        start_time = time.monotonic()
+        first_tick = ticks[0]
+        shift = tickDiff(first_tick, self.get_current_tick())
+        for tick in ticks:
+            if speed:
+                delay = tickDiff(first_tick, tick) / 1_000_000 / speed - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            tick = (tick + shift) & 0xFFFFFFFF
+            ahead = tickDiff(self.get_current_tick(), tick)
+            if ahead < 1 << 31:
+                self.tick_offset += ahead
+            self.inject_edge(gpio, tick, 1)
+
+EDGE_RECORD = struct.Struct("<dII")  # sama dengan RAW_EDGE_RECORD di new.py
+TRAIN_GAP_US = 300_000  # sama dengan ambang akhir rangkaian model default new.py (3 x 0.1 detik)
+
+def load_edge_export(path, gap_us=TRAIN_GAP_US):
+    """Membaca ekspor .npy dari /api/debug/edges, dipecah per rangkaian pulsa (ganti transaksi atau jeda > gap_us)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:6] != b"\x93NUMPY":
+        raise ValueError(f"{path} bukan file NPY")
+    header_len, = struct.unpack_from("<H", data, 8)
+    header = ast.literal_eval(data[10:10 + header_len].decode("latin1"))
+    if [tuple(field) for field in header["descr"]] != [("time", "<f8"), ("tick", "<u4"), ("trx", "<u4")]:
+        raise ValueError(f"dtype {header['descr']} bukan ekspor tepi bill acceptor")
+
+    notes = []
+    last = None
+    for _time, tick, tag in EDGE_RECORD.iter_unpack(data[10 + header_len:]):
+        if last is None or tag != last[1] or tickDiff(last[0], tick) > gap_us:
+            notes.append({"nominal": None, "ticks": []})
+        notes[-1]["ticks"].append(tick)
+        last = (tick, tag)
+    return notes
+
+def load_trace(path, gap_us=TRAIN_GAP_US):
+    """Membaca korpus rekaman JSON lines: satu baris per lembar uang, {"nominal": 5000, "ticks": [...]}.
+
+    File .npy hasil /api/debug/edges juga diterima (tanpa label nominal), dipecah per lembar pada jeda > gap_us.
+    """
+    if path.endswith(".npy"):
+        return load_edge_export(path, gap_us)
+
+    notes = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                note = json.loads(line)
+                notes.append({"nominal": note.get("nominal"), "ticks": [int(tick) for tick in note["ticks"]]})
+    return notes
@@ -0,0 +1,255 @@
+"""Analitik log transaksi: membaca log.txt dan segmen rotasi .gz secara streaming menjadi record per transaksi.
+
+Posisi byte yang sudah dibaca disimpan di file state, jadi menjalankan ulang hanya memproses baris baru.
+Segmen .gz hasil rotasi dikenali dari baris awalnya, sehingga isi log.txt yang sudah dibaca sebelum
+dirotasi tidak dihitung dua kali. Memori konstan: hanya transaksi yang sedang terbuka per perangkat
+dan ringkasan harian/per denominasi yang disimpan.
+
+Contoh:
+    python logstats.py                                   # LOG_DIR default, ringkasan ke stdout
+    python logstats.py --log-dir /var/www/html/logs --records transaksi.jsonl
+    python logstats.py --json                            # ringkasan dalam JSON
+    python logstats.py --reset                           # abaikan state, proses ulang semua segmen
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+LOG_DIR = os.environ.get("BILL_LOG_DIR", "/var/www/html/logs")
+HEAD_BYTES = 256  # Panjang awal segmen yang dipakai sebagai sidik jari
+
+LINE_PATTERN = re.compile(r"^\[(?P<date>\d{4}-\d{2}-\d{2}) (?P<time>\d{2}:\d{2}:\d{2})\] (?:\[(?P<device>[^\]]+)\] )?(?P<message>.*)$")
+EVENT_PATTERNS = [
+    ("start", re.compile(r"🔔 Transaksi dimulai! ID: (?P<id_trx>.+?), Token: (?P<token>.+?), Tagihan: Rp\.(?P<price>\d+)")),
+    ("credit", re.compile(r"💰 Koreksi pulsa: (?P<raw>\d+) -> (?P<corrected>\d+) \((?P<nominal>\d+)\) \| Total: Rp\.(?P<total>\d+)")),
+    ("invalid", re.compile(r"⚠️ Pulsa (?P<raw>\d+) tidak valid!")),
+    ("retry", re.compile(r"🔄 Pembayaran kurang, percobaan (?P<attempt>\d+)/")),
+    ("timeout", re.compile(r"⏰ Timeout! Kurang: Rp\.(?P<due>\d+)")),
+    ("done", re.compile(r"✅ Transaksi (?:selesai|sukses), (?P<kind>total|kelebihan): Rp\.(?P<amount>\d+)")),
+    ("cancel", re.compile(r"🚫 Pembayaran kurang dan telah melebihi toleransi")),
+    ("resume", re.compile(r"♻️ Melanjutkan transaksi (?P<id_trx>.+?):")),
+    ("reset", re.compile(r"🔄 Transaksi di-reset ke default\.")),
+    ("settlement_sent", re.compile(r"✅ Pembayaran sukses|✅ Pembayaran sudah selesai sebelumnya")),
+    ("settlement_rejected", re.compile(r"⚠️ Gagal \(400\)")),
+]
+
+def new_state():
+    return {"segments": [], "active": None, "open": {}, "daily": {}, "denominations": {}}
+
+def load_state(path):
+    if not os.path.exists(path):
+        return new_state()
+    with open(path) as f:
+        return {**new_state(), **json.load(f)}
+
+def save_state(path, state):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+def segment_head(opener, path, length=HEAD_BYTES):
+    """Sidik jari awal segmen (isi terdekompresi), dipakai untuk mengenali log.txt yang sudah dirotasi."""
+    with opener(path, "rb") as f:
+        head = f.read(length)
+    return hashlib.sha1(head).hexdigest(), len(head)
+
+def daily_summary(state, date):
+    return state["daily"].setdefault(date, {
+        "transactions": 0, "completed": 0, "cancelled": 0, "timeouts": 0, "credited": 0,
+        "notes": 0, "corrections": 0, "invalid_trains": 0, "settlements_sent": 0, "settlements_rejected": 0
+    })
+
+def close_transaction(state, device, records):
+    record = state["open"].pop(device, None)
+    if record is not None and records is not None:
+        records.write(json.dumps(record) + "\n")
+
+def handle_line(state, line, records):
+    """Memperbarui transaksi terbuka dan ringkasan dari satu baris log."""
+    match = LINE_PATTERN.match(line)
+    if match is None:
+        return
+    device = match["device"] or "-"
+    date = match["date"]
+    timestamp = f"{date} {match['time']}"
+    message = match["message"]
+
+    for event, pattern in EVENT_PATTERNS:
+        found = pattern.search(message)
+        if found is not None:
+            break
+    else:
+        return
+
+    day = daily_summary(state, date)
+    record = state["open"].get(device)
+
+    if event == "start":
+        close_transaction(state, device, records)
+        state["open"][device] = {
+            "device": device, "id_trx": found["id_trx"], "token": found["token"], "price": int(found["price"]),
+            "start": timestamp, "end": None, "credited": 0, "notes": [], "corrections": 0, "invalid": 0,
+            "retries": 0, "timeouts": 0, "overpaid": 0, "outcome": "unknown", "resumed": False
+        }
+        day["transactions"] += 1
+    elif event == "settlement_sent":
+        day["settlements_sent"] += 1
+    elif event == "settlement_rejected":
+        day["settlements_rejected"] += 1
+    elif event == "resume":
+        if record is None or record["id_trx"] != found["id_trx"]:
+            close_transaction(state, device, records)
+            state["open"][device] = record = {
+                "device": device, "id_trx": found["id_trx"], "token": None, "price": None, "start": timestamp,
+                "end": None, "credited": 0, "notes": [], "corrections": 0, "invalid": 0, "retries": 0,
+                "timeouts": 0, "overpaid": 0, "outcome": "unknown", "resumed": True
+            }
+        record["resumed"] = True
+    elif event == "credit":
+        raw, corrected, nominal = int(found["raw"]), int(found["corrected"]), int(found["nominal"])
+        denomination = state["denominations"].setdefault(str(nominal), {"notes": 0, "corrections": 0, "raw_pulses": {}})
+        denomination["notes"] += 1
+        denomination["raw_pulses"][str(raw)] = denomination["raw_pulses"].get(str(raw), 0) + 1
+        day["notes"] += 1
+        day["credited"] += nominal
+        if raw != corrected:
+            denomination["corrections"] += 1
+            day["corrections"] += 1
+        if record is not None:
+            record["notes"].append(nominal)
+            record["credited"] = int(found["total"])
+            record["corrections"] += raw != corrected
+    elif event == "invalid":
+        day["invalid_trains"] += 1
+        if record is not None:
+            record["invalid"] += 1
+    elif record is None:
+        return
+    elif event == "retry":
+        record["retries"] = int(found["attempt"])
+    elif event == "timeout":
+        record["timeouts"] += 1
+        day["timeouts"] += 1
+    elif event == "done":
+        record["outcome"] = "completed"
+        record["overpaid"] = int(found["amount"]) if found["kind"] == "kelebihan" else 0
+        record["end"] = timestamp
+        day["completed"] += 1
+    elif event == "cancel":
+        record["outcome"] = "cancelled"
+        record["end"] = timestamp
+        day["cancelled"] += 1
+    elif event == "reset":
+        record["end"] = record["end"] or timestamp
+        close_transaction(state, device, records)
+
+def process_stream(state, f, skip, records):
+    """Membaca baris lengkap mulai dari byte skip; mengembalikan offset setelah baris lengkap terakhir."""
+    # Seek maju pada GzipFile mendekompresi per blok, jadi tetap memori konstan
+    f.seek(skip)
+    offset = skip
+
+    for line in f:
+        if not line.endswith(b"\n"):
+            break  # Baris terakhir yang belum selesai ditulis dibaca lagi di run berikutnya
+        offset += len(line)
+        handle_line(state, line.decode("utf-8", "replace").rstrip("\n"), records)
+    return offset
+
+def process_log_dir(state, log_dir, records):
+    """Memproses segmen .gz yang belum pernah dibaca lalu log.txt aktif dari offset terakhir."""
+    log_file = os.path.join(log_dir, "log.txt")
+    segments = sorted(glob.glob(f"{log_file}.*.gz"))
+    done = set(state["segments"])
+    active = state["active"]
+
+    for segment in segments:
+        name = os.path.basename(segment)
+        if name in done:
+            continue
+        skip = 0
+        if active is not None and segment_head(gzip.open, segment, active["head_len"])[0] == active["head"]:
+            # Segmen ini adalah log.txt yang sebagian sudah dibaca sebelum rotasi
+            skip = active["offset"]
+            active = None
+        with gzip.open(segment, "rb") as f:
+            process_stream(state, f, skip, records)
+        done.add(name)
+
+    if os.path.exists(log_file):
+        stat = os.stat(log_file)
+        skip = 0
+        if (active is not None and active["inode"] == stat.st_ino and active["offset"] <= stat.st_size
+                and segment_head(open, log_file, active["head_len"])[0] == active["head"]):
+            skip = active["offset"]
+        with open(log_file, "rb") as f:
+            offset = process_stream(state, f, skip, records)
+        head, head_len = segment_head(open, log_file, min(offset, HEAD_BYTES))
+        state["active"] = {"inode": stat.st_ino, "head": head, "head_len": head_len, "offset": offset}
+
+    # Segmen yang sudah dihapus rotasi tidak perlu diingat lagi
+    existing = {os.path.basename(segment) for segment in segments}
+    state["segments"] = sorted(done & existing)
+
+def print_summary(state):
+    print(f"{'Tanggal':<12}{'Trx':>6}{'Selesai':>9}{'Batal':>7}{'Timeout':>9}{'Lembar':>8}{'Koreksi':>9}{'Invalid':>9}{'Kredit (Rp)':>14}")
+    for date in sorted(state["daily"]):
+        day = state["daily"][date]
+        print(f"{date:<12}{day['transactions']:>6}{day['completed']:>9}{day['cancelled']:>7}{day['timeouts']:>9}"
+              f"{day['notes']:>8}{day['corrections']:>9}{day['invalid_trains']:>9}{day['credited']:>14,}")
+
+    print()
+    print(f"{'Nominal':>10}{'Lembar':>9}{'Koreksi':>9}  Distribusi pulsa mentah")
+    for nominal in sorted(state["denominations"], key=int):
+        denomination = state["denominations"][nominal]
+        histogram = ", ".join(f"{raw}:{count}" for raw, count in sorted(denomination["raw_pulses"].items(), key=lambda item: int(item[0])))
+        print(f"{int(nominal):>10,}{denomination['notes']:>9}{denomination['corrections']:>9}  {histogram}")
+
+    if state["open"]:
+        print()
+        still_open = ", ".join(f"{device}={record['id_trx']}" for device, record in state["open"].items())
+        print(f"Transaksi masih terbuka: {still_open}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Analitik streaming log transaksi bill acceptor.")
+    parser.add_argument("files", nargs="*", help="file log tertentu (.txt atau .gz); default semua segmen di --log-dir")
+    parser.add_argument("--log-dir", default=LOG_DIR)
+    parser.add_argument("--state", help="file state offset dan ringkasan (default: <log-dir>/.logstats.json)")
+    parser.add_argument("--records", help="tambahkan record per transaksi yang sudah selesai ke file JSON lines ini")
+    parser.add_argument("--json", action="store_true", help="cetak ringkasan sebagai JSON")
+    parser.add_argument("--reset", action="store_true", help="abaikan state lama dan proses ulang dari awal")
+    args = parser.parse_args()
+
+    state_path = args.state or os.path.join(args.log_dir, ".logstats.json")
+    state = new_state() if args.reset else load_state(state_path)
+    records = open(args.records, "a") if args.records else None
+
+    try:
+        if args.files:
+            # File eksplisit selalu dibaca penuh dan tidak mengubah offset log.txt
+            for path in args.files:
+                with (gzip.open if path.endswith(".gz") else open)(path, "rb") as f:
+                    process_stream(state, f, 0, records)
+        else:
+            process_log_dir(state, args.log_dir, records)
+    finally:
+        if records is not None:
+            records.close()
+
+    if not args.files:
+        save_state(state_path, state)
+
+    if args.json:
+        print(json.dumps({"daily": state["daily"], "denominations": state["denominations"], "open": state["open"]}, indent=2))
+    else:
+        print_summary(state)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,72 +1,731 @@
-import pigpio
 import time
 import datetime
 import os
+import array
+import struct
+import mmap
+import zlib
+import queue
+import gzip
+import json
+import collections
+import shutil
+import glob
+import sys
+import atexit
+import sqlite3
+import uuid
+import random
+import hmac
+import enum
+import bisect
+import concurrent.futures
+import asyncio
+import functools
+import itertools
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify
 import threading
 
-# Konfigurasi PIN GPIO
+# Server WSGI produksi (opsional); tanpa waitress kembali ke server pengembangan Flask
+try:
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
+
+# Backend GPIO: pigpio (default) atau simulasi untuk pengembangan/replay (BILL_GPIO_BACKEND=sim)
+if os.environ.get("BILL_GPIO_BACKEND", "pigpio") == "sim":
+    import gpio_sim as pigpio
+else:
+    import pigpio
+
+# Konfigurasi PIN GPIO (default untuk satu bill acceptor)
 BILL_ACCEPTOR_PIN = 14
 EN_PIN = 15
 
+# Daftar bill acceptor yang dilayani proses ini.
+# Dapat diganti lewat DEVICE_FILE, mis. {"devices": [{"device_id": "bic01", "pin": 14, "en_pin": 15}, ...]}
+DEVICE_FILE = os.environ.get("BILL_DEVICE_FILE", "/etc/billacceptor/devices.json")
+DEFAULT_DEVICES = [
+    {"device_id": "bic01", "pin": BILL_ACCEPTOR_PIN, "en_pin": EN_PIN}
+]
+
 # Konfigurasi transaksi
 TIMEOUT = 20
+SETTLE_TIME = 2
 DEBOUNCE_TIME = 0.05
-TOLERANCE = 2
 MAX_RETRY = 2 
+DRIVER_ERROR_BACKOFF = 1  # Jeda (detik) setelah handler state gagal, agar error berulang tidak memutar loop
 
-# Mapping jumlah pulsa ke nominal uang
-PULSE_MAPPING = {
-    1: 1000,
-    2: 2000,
-    5: 5000,
-    10: 10000,
-    20: 20000,
-    50: 50000,
-    100: 100000
+# Deteksi akhir rangkaian pulsa: rangkaian ditutup setelah jeda gap_multiple x periode pulsa (diukur dari tick
+# pigpio, minimal pulse_gap model), dibatasi TRAIN_END_MIN..SETTLE_TIME. Device bisa memilih "model" atau override.
+ACCEPTOR_MODELS = {
+    "default": {"pulse_gap": 0.1, "gap_multiple": 3},
+    "slow": {"pulse_gap": 0.3, "gap_multiple": 3}
 }
+TRAIN_END_MIN = 0.15
+
+# Kalibrasi debounce dan periode pulsa per perangkat dari interval tepi mentah (live atau rekaman)
+CALIBRATION_MIN_SAMPLES = 200
+CALIBRATION_BOUNCE_RATIO = 0.5  # Interval < rasio x median dianggap pantulan kontak, bukan pulsa
+CALIBRATION_LIMITS = {"debounce": (0.005, 0.1), "pulse_gap": (0.03, 0.5)}
+
+# Konfigurasi capture pulsa (ring buffer tick pigpio)
+EDGE_BUFFER_SIZE = 4096
+EDGE_DRAIN_WAIT = 0.005  # Jeda driver saat masih ada tepi yang belum dibaca process_edges
+NOTIFY_REPORT = struct.Struct("HHII")  # seqno, flags, tick, level
+NOTIFY_READ_REPORTS = 256
+
+# Konfigurasi rekaman tepi mentah untuk diagnosa (ring buffer terpisah, tidak ikut dikonsumsi decode)
+RAW_EDGE_BUFFER_SIZE = 16384
+RAW_EDGE_TRX_HISTORY = 64  # Jumlah pasangan tag -> id_trx yang diingat
+RAW_EDGE_RECORD = struct.Struct("<dII")  # waktu (epoch), tick pigpio, tag transaksi (0 = di luar transaksi)
+RAW_EDGE_NPY_DESCR = [("time", "<f8"), ("tick", "<u4"), ("trx", "<u4")]
+
+# Konfigurasi pencarian token (webhook + polling fallback dengan backoff)
+POLL_INTERVAL_MIN = 1
+POLL_INTERVAL_MAX = 30
+TOKEN_MAX_AGE_MINUTES = 3
+TOKEN_QUEUE_SIZE = 16
+TOKEN_SEEN_SIZE = 512  # Jumlah token yang diingat sudah diproses/ditolak per perangkat
+TOKEN_CURSOR_PARAM = os.environ.get("BILL_TOKEN_CURSOR_PARAM")  # Query param "sejak" TOKEN_API, kosong = tidak didukung
+WEBHOOK_TOKEN = os.environ.get("BILL_WEBHOOK_TOKEN")  # Wajib untuk webhook; tanpa secret webhook ditolak, hanya polling
+
+# Tabel denominasi: jumlah pulsa per nominal dan jendela toleransi (min/max pulsa mentah) per nominal.
+# Dapat diganti lewat DENOMINATION_FILE, mis. {"denominations": [{"pulses": 5, "nominal": 5000, "tolerance": 2}]}
+DENOMINATION_FILE = os.environ.get("BILL_DENOMINATION_FILE", "/etc/billacceptor/denominations.json")
+DEFAULT_DENOMINATIONS = [
+    {"pulses": 1, "nominal": 1000, "min": 1, "max": 1},
+    {"pulses": 2, "nominal": 2000, "min": 2, "max": 4},
+    {"pulses": 5, "nominal": 5000, "min": 5, "max": 7},
+    {"pulses": 10, "nominal": 10000, "min": 8, "max": 12},
+    {"pulses": 20, "nominal": 20000, "min": 18, "max": 22},
+    {"pulses": 50, "nominal": 50000, "min": 48, "max": 52},
+    {"pulses": 100, "nominal": 100000, "min": 98, "max": 102}
+]
 
 # API URL
-TOKEN_API = "https://api-dev.xpdisi.id/invoice/device/bic01"
+TOKEN_API = "https://api-dev.xpdisi.id/invoice/device/"
 INVOICE_API = "https://api-dev.xpdisi.id/invoice/"
 BILL_API = "https://api-dev.xpdisi.id/order/billacceptor"
 
+# Konfigurasi HTTP client (satu session keep-alive untuk semua endpoint)
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUTS = {
+    "token": 1,
+    "invoice": 5,
+    "bill": 5
+}
+HTTP_RETRY = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+HTTP_COMPRESS_REQUESTS = False
+HTTP_LATENCY_SAMPLES = 256
+
+# Konfigurasi circuit breaker backend (semua endpoint di host yang sama, jadi satu breaker)
+BREAKER_FAILURE_THRESHOLD = 3  # Kegagalan berturut-turut sebelum breaker terbuka
+BREAKER_OPEN_BASE = 2  # Jeda pertama sebelum probe, berlipat dua tiap probe gagal
+BREAKER_OPEN_MAX = 300
+
+# Konfigurasi cache invoice (TTL, negative cache untuk invoice yang sudah dibayar, fan-out)
+INVOICE_CACHE_TTL = 5
+INVOICE_PAID_CACHE_TTL = 600
+INVOICE_CACHE_SIZE = 256
+INVOICE_FANOUT_WORKERS = 4  # Maksimal GET invoice paralel saat beberapa token baru ditemukan
+
+# Konfigurasi network core asyncio: thread executor untuk request blocking dan batas waktu total per operasi (termasuk retry)
+NETWORK_WORKERS = HTTP_POOL_SIZE
+NETWORK_DEADLINES = {"token": 4, "invoice": 12}
+
+# Konfigurasi metrik /metrics: (tipe, keterangan, bucket histogram dalam detik/jumlah)
+METRICS = {
+    "bill_pulses_total": ("counter", "Pulsa yang lolos debounce", None),
+    "bill_pulses_debounced_total": ("counter", "Tepi yang dibuang oleh debounce", None),
+    "bill_inter_pulse_interval_seconds": ("histogram", "Jarak antar pulsa dalam satu rangkaian",
+                                          (0.02, 0.05, 0.075, 0.1, 0.125, 0.15, 0.2, 0.3, 0.5, 1, 2)),
+    "bill_pulse_trains_total": ("counter", "Rangkaian pulsa per jumlah pulsa mentah dan hasil koreksi", None),
+    "bill_pulse_trains_rejected_total": ("counter", "Rangkaian pulsa yang ditolak per alasan", None),
+    "bill_credit_rupiah_total": ("counter", "Total nominal yang dikreditkan", None),
+    "bill_transactions_started_total": ("counter", "Transaksi yang dimulai", None),
+    "bill_transaction_timeouts_total": ("counter", "Transaksi yang berakhir karena timeout", None),
+    "bill_insufficient_payment_retries_total": ("counter", "Perpanjangan waktu karena pembayaran kurang", None),
+    "bill_settlements_total": ("counter", "Settlement lokal per status (queued/cancelled)", None),
+    "bill_settlement_latency_seconds": ("histogram", "Waktu dari settlement dicatat ke outbox hingga hasil final backend",
+                                        (0.1, 0.25, 0.5, 1, 2.5, 5, 30, 60, 300, 1800)),
+    "bill_settlement_results_total": ("counter", "Hasil pengiriman settlement per status", None),
+    "bill_http_request_duration_seconds": ("histogram", "Latensi request HTTP ke backend per endpoint",
+                                           (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    "bill_http_responses_total": ("counter", "Respon HTTP per endpoint dan kode (error = gagal koneksi)", None),
+    "bill_backend_breaker_transitions_total": ("counter", "Perpindahan state circuit breaker backend", None),
+    "bill_backend_requests_rejected_total": ("counter", "Request yang ditolak lokal karena breaker terbuka", None)
+}
+
 # Lokasi penyimpanan log transaksi
-LOG_DIR = "/var/www/html/logs"
+LOG_DIR = os.environ.get("BILL_LOG_DIR", "/var/www/html/logs")
 LOG_FILE = os.path.join(LOG_DIR, "log.txt")
 
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+# Konfigurasi penulisan log (writer latar belakang + rotasi)
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 1
+LOG_FSYNC_POLICY = "interval"  # "always", "interval", atau "never"
+LOG_FSYNC_INTERVAL = 30
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_ROTATE_DAILY = True
+LOG_BACKUP_COUNT = 10
+
+# Level log per kategori (debug/info/warning/error/off), dapat diganti lewat BILL_LOG_LEVELS,
+# mis. "poll=warning,console=off". Kategori "console" adalah output per pulsa/countdown ke stdout.
+LOG_LEVEL_ORDER = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+DEFAULT_LOG_LEVELS = {"transaction": "info", "poll": "info", "network": "info", "console": "debug"}
+
+def load_log_levels():
+    """Level log per kategori: DEFAULT_LOG_LEVELS ditimpa isi BILL_LOG_LEVELS."""
+    levels = dict(DEFAULT_LOG_LEVELS)
+    for entry in filter(None, os.environ.get("BILL_LOG_LEVELS", "").split(",")):
+        category, _, level = (part.strip() for part in entry.partition("="))
+        if level.lower() not in LOG_LEVEL_ORDER:
+            raise ValueError(f"Level log tidak dikenal untuk kategori {category}: {level}")
+        levels[category] = level.lower()
+    return levels
+
+LOG_LEVELS = load_log_levels()
+LOG_SUMMARY_INTERVAL = 3600  # Pesan berulang ditulis sekali, lalu diringkas satu baris per interval
+
+# Lokasi data lokal (outbox settlement), tidak di bawah direktori web
+DATA_DIR = os.environ.get("BILL_DATA_DIR", "/var/lib/billacceptor")
+OUTBOX_DB = os.path.join(DATA_DIR, "outbox.db")
+JOURNAL_DB = os.path.join(DATA_DIR, "journal.db")
+JOURNAL_QUERY_LIMIT = 1000
+
+# Konfigurasi checkpoint transaksi aktif (record tetap di file mmap, dua slot bergantian)
+CHECKPOINT_FILE = os.path.join(DATA_DIR, "checkpoint-{device_id}.bin")
+CALIBRATION_FILE = os.path.join(DATA_DIR, "calibration.json")
+CHECKPOINT_RECORD = struct.Struct("<4sBBQqqd128s128s")  # magic, aktif, retry, seq, tagihan, total, waktu, id_trx (JSON), token
+CHECKPOINT_MAGIC = b"BAC1"
+CHECKPOINT_FIELD_SIZE = 128  # Panjang maksimal id_trx (JSON) dan token dalam byte, sama dengan 128s di CHECKPOINT_RECORD
+CHECKPOINT_SLOT_SIZE = 512
+CHECKPOINT_SYNC = True  # msync tiap checkpoint agar bertahan saat listrik mati, bukan hanya saat proses crash
+
+# Konfigurasi pengiriman settlement (outbox + retry)
+OUTBOX_RETRY_BASE = 2
+OUTBOX_RETRY_MAX = 300
+
+# Konfigurasi server HTTP dan event stream kiosk (SSE)
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 5000
+SERVER_THREADS = 16  # Tiap klien SSE memakai satu thread server selama terhubung
+EVENT_MAX_CLIENTS = 8
+EVENT_QUEUE_SIZE = 256  # Event per klien; klien lambat kehilangan event lama, bukan menahan jalur pulsa
+EVENT_HEARTBEAT = 15
+
+for directory in (LOG_DIR, DATA_DIR):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
 # Inisialisasi Flask
 app = Flask(__name__)
 
-# Variabel Global
-pulse_count = 0
-pending_pulse_count = 0
-last_pulse_time = time.time()
-transaction_active = False
-total_inserted = 0
-id_trx = None
-payment_token = None
-product_price = 0
-last_pulse_received_time = time.time()
-timeout_thread = None 
-insufficient_payment_count = 0
-transaction_lock = threading.Lock()
-log_lock = threading.Lock()
+# Variabel Global (infrastruktur bersama; state transaksi ada di BillAcceptor per perangkat)
+devices = {}
+metric_values = {}
+metrics_lock = threading.Lock()
+http_stats = {}
+invoice_cache = collections.OrderedDict()  # token -> (kedaluwarsa, invoice, etag, last_modified)
+invoice_inflight = {}
+invoice_cache_lock = threading.Lock()
+http_stats_lock = threading.Lock()
 print_lock = threading.Lock()
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_dropped = 0
+log_repeats = {}  # pesan -> [awal jendela ringkasan, jumlah pengulangan yang belum ditulis]
+log_repeats_lock = threading.Lock()
+outbox_lock = threading.Lock()
+journal_lock = threading.Lock()
+event_subscribers = ()  # Tuple immutable, diganti utuh saat klien SSE masuk/keluar
+event_subscribers_lock = threading.Lock()
+event_seq = itertools.count(1)
 
 # Fungsi log transaction
-def log_transaction(message):
+def log_enabled(category, level="info"):
+    """True jika pesan level ini lolos level kategori (kategori tak dikenal memakai level transaction)."""
+    threshold = LOG_LEVELS.get(category, LOG_LEVELS["transaction"])
+    return LOG_LEVEL_ORDER[level] >= LOG_LEVEL_ORDER[threshold]
+
+# Output stdout di jalur pulsa, dimatikan dengan BILL_LOG_LEVELS=console=off (dicek sekali saat start)
+CONSOLE_TRACE = log_enabled("console", "debug")
+
+def log_transaction(message, category="transaction", level="info", summarize=False):
+    """Memasukkan pesan ke antrian log tanpa pernah menunggu disk.
+
+    summarize=True untuk pesan yang berulang (polling): kemunculan pertama ditulis, pengulangan
+    berikutnya hanya dihitung dan diringkas oleh log_writer tiap LOG_SUMMARY_INTERVAL.
+    """
+    global log_dropped
+
+    if not log_enabled(category, level):
+        return
+    if summarize:
+        with log_repeats_lock:
+            repeat = log_repeats.get(message)
+            if repeat is not None:
+                repeat[1] += 1
+                return
+            log_repeats[message] = [time.monotonic(), 0]
+
+    timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+    try:
+        log_queue.put_nowait(f"{timestamp} {message}\n")
+    except queue.Full:
+        log_dropped += 1
+
+def collapse_log_repeats(force=False):
+    """Baris ringkasan untuk pesan berulang yang jendelanya sudah habis (force=True: semua, saat berhenti)."""
+    now = time.monotonic()
+    lines = []
     timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with log_lock:
-        with open(LOG_FILE, "a") as log:
-            log.write(f"{timestamp} {message}\n")
-            
-    with print_lock:
-        print(f"{timestamp} {message}")
+    with log_repeats_lock:
+        for message, (since, count) in list(log_repeats.items()):
+            if not force and now - since < LOG_SUMMARY_INTERVAL:
+                continue
+            if count == 0:
+                # Tidak berulang lagi: kemunculan berikutnya ditulis lengkap
+                del log_repeats[message]
+                continue
+            window = now - since
+            span = f"{window / 60:.0f} menit" if window >= 60 else f"{window:.0f} detik"
+            lines.append(f"{timestamp} {message} (×{count} dalam {span} terakhir)\n")
+            log_repeats[message] = [now, 0]
+    return lines
+
+def open_log_segment():
+    """Membuka log.txt untuk append beserta tanggal segmen (untuk rotasi harian)."""
+    if os.path.exists(LOG_FILE):
+        segment_date = datetime.date.fromtimestamp(os.path.getmtime(LOG_FILE))
+    else:
+        segment_date = datetime.date.today()
+    return open(LOG_FILE, "a", encoding="utf-8"), segment_date
+
+def rotate_log_segment(log_file):
+    """Menutup segmen aktif, mengompres ke .gz, dan membuang segmen lama di luar LOG_BACKUP_COUNT."""
+    log_file.close()
+    rotated = f"{LOG_FILE}.{datetime.datetime.now():%Y%m%d-%H%M%S}"
+    os.replace(LOG_FILE, rotated)
+
+    with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(rotated)
+
+    for old_segment in sorted(glob.glob(f"{LOG_FILE}.*.gz"))[:-LOG_BACKUP_COUNT]:
+        os.remove(old_segment)
+
+    return open_log_segment()
+
+def log_writer():
+    """Thread penulis log: menulis per batch, fsync sesuai LOG_FSYNC_POLICY, dan merotasi file."""
+    global log_dropped
+
+    log_file, segment_date = open_log_segment()
+    last_fsync = time.monotonic()
+    dirty = False
+    running = True
+
+    while running:
+        try:
+            batch = [log_queue.get(timeout=LOG_FLUSH_INTERVAL)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if None in batch:
+            running = False
+            batch = [line for line in batch if line is not None]
+
+        batch.extend(collapse_log_repeats(force=not running))
+
+        if log_dropped:
+            dropped, log_dropped = log_dropped, 0
+            timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+            batch.append(f"{timestamp} ⚠️ {dropped} pesan log terbuang karena antrian penuh!\n")
+
+        if batch:
+            today = datetime.date.today()
+            if log_file.tell() >= LOG_MAX_BYTES or (LOG_ROTATE_DAILY and today != segment_date):
+                log_file, segment_date = rotate_log_segment(log_file)
+
+            data = "".join(batch)
+            log_file.write(data)
+            log_file.flush()
+            dirty = True
+
+            with print_lock:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+
+        if dirty and LOG_FSYNC_POLICY != "never" and (LOG_FSYNC_POLICY == "always" or not running or
+                                                      time.monotonic() - last_fsync >= LOG_FSYNC_INTERVAL):
+            os.fsync(log_file.fileno())
+            last_fsync = time.monotonic()
+            dirty = False
+
+    log_file.close()
+
+def stop_log_writer():
+    """Mengosongkan antrian log ke disk saat proses berhenti."""
+    try:
+        log_queue.put(None, timeout=1)
+    except queue.Full:
+        return
+    log_writer_thread.join(timeout=5)
+
+log_writer_thread = threading.Thread(target=log_writer, daemon=True)
+log_writer_thread.start()
+atexit.register(stop_log_writer)
+
+# Metrik (format teks Prometheus), cukup murah untuk dipanggil di jalur pulsa
+def inc_metric(name, value=1, **labels):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
+
+def observe_metric(name, value, **labels):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    buckets = METRICS[name][2]
+    with metrics_lock:
+        histogram = metric_values.get(key)
+        if histogram is None:
+            # [hitungan per bucket (non-kumulatif) + +Inf, sum, count]
+            histogram = metric_values[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def format_labels(labels, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in (*labels, *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render_metrics():
+    """Menyusun semua metrik dalam format teks Prometheus."""
+    with metrics_lock:
+        snapshot = {key: (value if not isinstance(value, list) else (list(value[0]), value[1], value[2]))
+                    for key, value in metric_values.items()}
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (metric_name, labels), value in sorted(snapshot.items()):
+            if metric_name != name:
+                continue
+            if metric_type == "counter":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+    with outbox_lock:
+        pending = outbox_db.execute("SELECT COUNT(*) FROM settlement_outbox WHERE status = 'pending'").fetchone()[0]
+    lines.append("# HELP bill_outbox_pending Settlement yang belum terkirim ke backend")
+    lines.append("# TYPE bill_outbox_pending gauge")
+    lines.append(f"bill_outbox_pending {pending}")
+
+    lines.append("# HELP bill_device_active Transaksi sedang berjalan pada perangkat")
+    lines.append("# TYPE bill_device_active gauge")
+    for device in devices.values():
+        lines.append(f'bill_device_active{{device="{device.device_id}"}} {int(device.transaction_active)}')
+
+    return "\n".join(lines) + "\n"
+
+# Inisialisasi HTTP session (connection pooling + keep-alive + retry GET)
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRY)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+def record_http_latency(endpoint, elapsed, status_code):
+    """Mencatat latensi dan status satu request ke statistik per endpoint."""
+    elapsed_ms = elapsed * 1000
+    with http_stats_lock:
+        stats = http_stats.setdefault(endpoint, {
+            "count": 0,
+            "errors": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            "last_ms": 0.0,
+            "last_status": None,
+            "samples": collections.deque(maxlen=HTTP_LATENCY_SAMPLES)
+        })
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["last_ms"] = elapsed_ms
+        stats["last_status"] = status_code
+        stats["samples"].append(elapsed_ms)
+        if status_code is None or status_code >= 500:
+            stats["errors"] += 1
+
+    observe_metric("bill_http_request_duration_seconds", elapsed, endpoint=endpoint)
+    inc_metric("bill_http_responses_total", endpoint=endpoint, code=status_code or "error")
+
+def http_latency_stats():
+    """Ringkasan latensi per endpoint (rata-rata, p50, p95, maks) dalam milidetik."""
+    summary = {}
+    with http_stats_lock:
+        for endpoint, stats in http_stats.items():
+            samples = sorted(stats["samples"])
+            summary[endpoint] = {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["count"], 1),
+                "p50_ms": round(samples[len(samples) // 2], 1),
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+                "max_ms": round(stats["max_ms"], 1),
+                "last_ms": round(stats["last_ms"], 1),
+                "last_status": stats["last_status"]
+            }
+    return summary
+
+class BackendUnavailable(requests.exceptions.ConnectionError):
+    """Request tidak dikirim karena circuit breaker backend sedang terbuka."""
+
+class CircuitBreaker:
+    """Circuit breaker backend: closed -> open setelah beberapa kegagalan berturut-turut -> half_open saat jeda habis.
+
+    Selama open semua request gagal lokal tanpa menyentuh jaringan. Saat jeda habis hanya satu request
+    yang lolos sebagai probe; berhasil berarti closed lagi, gagal berarti open dengan jeda dua kali lipat
+    (dengan jitter). Log hanya ditulis saat backend dinyatakan down dan saat pulih, bukan tiap kegagalan.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, base=BREAKER_OPEN_BASE, maximum=BREAKER_OPEN_MAX):
+        self.threshold = threshold
+        self.base = base
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0  # Jumlah open berturut-turut sejak terakhir closed, menentukan lama jeda
+        self.open_until = 0
+        self.down_since = None
+        self.last_error = None
+        self.listeners = []
+
+    def ready(self):
+        """True jika request boleh dicoba sekarang (closed, atau open dan jeda sudah habis)."""
+        return self.state == "closed" or (self.state == "open" and time.time() >= self.open_until)
+
+    def retry_in(self):
+        """Detik sampai request berikutnya boleh dicoba; None jika menunggu hasil probe."""
+        if self.state == "half_open":
+            return None
+        if self.state == "closed":
+            return 0
+        return max(0, self.open_until - time.time())
+
+    def allow(self):
+        """Dipanggil sebelum setiap request; saat jeda habis hanya pemanggil pertama yang menjadi probe."""
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" or time.time() < self.open_until:
+                return False
+            self.state = "half_open"
+        self.transition("half_open")
+        return True
+
+    def record_success(self):
+        with self.lock:
+            previous = self.state
+            self.failures = 0
+            if previous == "closed":
+                return
+            self.state = "closed"
+            self.trips = 0
+            down_for = time.time() - self.down_since
+            self.down_since = None
+        log_transaction(f"✅ Backend pulih setelah {down_for:.0f} detik, polling kembali normal.", category="network")
+        self.transition("closed")
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            # Kegagalan request lama yang selesai setelah breaker terbuka tidak memperpanjang jeda
+            if self.state == "open" or (self.state == "closed" and self.failures < self.threshold):
+                return
+            first_trip = self.state == "closed"
+            self.trips += 1
+            delay = min(self.base * (2 ** (self.trips - 1)), self.maximum) * random.uniform(0.8, 1.2)
+            self.state = "open"
+            self.open_until = time.time() + delay
+            if first_trip:
+                self.down_since = time.time()
+        if first_trip:
+            log_transaction(f"🔌 Backend tidak merespons ({self.failures}x berturut-turut), request ditahan dengan backoff: {error}",
+                            category="network", level="warning")
+        self.transition("open")
+
+    def transition(self, state):
+        inc_metric("bill_backend_breaker_transitions_total", state=state)
+        for listener in self.listeners:
+            listener(state)
+
+    def status(self):
+        retry_in = self.retry_in()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "retry_in": None if retry_in is None else round(retry_in, 1),
+            "down_since": datetime.datetime.fromtimestamp(self.down_since).isoformat() if self.down_since else None,
+            "last_error": self.last_error
+        }
+
+backend_breaker = CircuitBreaker()
+
+def api_request(endpoint, method, url, **kwargs):
+    """Request ke backend lewat session bersama dengan timeout per endpoint, circuit breaker dan statistik latensi."""
+    if not backend_breaker.allow():
+        inc_metric("bill_backend_requests_rejected_total", endpoint=endpoint)
+        raise BackendUnavailable(f"backend tidak tersedia (circuit breaker {backend_breaker.state})")
+
+    kwargs.setdefault("timeout", HTTP_TIMEOUTS[endpoint])
+
+    if HTTP_COMPRESS_REQUESTS and "json" in kwargs:
+        kwargs["data"] = gzip.compress(json.dumps(kwargs.pop("json")).encode("utf-8"))
+        kwargs["headers"] = {**kwargs.get("headers", {}), "Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+    start = time.perf_counter()
+    try:
+        response = http_session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        record_http_latency(endpoint, time.perf_counter() - start, None)
+        backend_breaker.record_failure(e)
+        raise
+    except Exception as e:
+        # Probe yang gagal di luar requests tetap harus melepas state half_open
+        backend_breaker.record_failure(e)
+        raise
+
+    record_http_latency(endpoint, time.perf_counter() - start, response.status_code)
+    if response.status_code >= 500:
+        backend_breaker.record_failure(f"HTTP {response.status_code}")
+    else:
+        backend_breaker.record_success()
+    return response
+
+# Cache invoice per payment token
+def get_invoice(token):
+    """Detail invoice lewat cache TTL; mengembalikan (invoice atau None jika 404, dari_cache).
+
+    Respon lain selain 200/304/404 menaikkan HTTPError agar token dicoba lagi, bukan ditandai sudah dilihat.
+
+    Invoice yang sudah dibayar disimpan lebih lama (negative cache). Entri kedaluwarsa divalidasi ulang
+    dengan If-None-Match/If-Modified-Since, dan request yang sedang berjalan untuk token yang sama ditunggu.
+    """
+    while True:
+        with invoice_cache_lock:
+            entry = invoice_cache.get(token)
+            if entry and entry[0] > time.time():
+                invoice_cache.move_to_end(token)
+                return entry[1], True
+            inflight = invoice_inflight.get(token)
+            if inflight is None:
+                invoice_inflight[token] = threading.Event()
+                break
+        inflight.wait(HTTP_TIMEOUTS["invoice"])
+
+    try:
+        headers = {}
+        if entry and entry[2]:
+            headers["If-None-Match"] = entry[2]
+        if entry and entry[3]:
+            headers["If-Modified-Since"] = entry[3]
+
+        response = api_request("invoice", "GET", f"{INVOICE_API}{token}", headers=headers)
+        if response.status_code == 304 and entry:
+            invoice = entry[1]
+        elif response.status_code == 200:
+            invoice_data = response.json()
+            if "data" not in invoice_data:
+                raise requests.exceptions.HTTPError(f"respon invoice {token} tanpa data", response=response)
+            invoice = invoice_data["data"]
+        elif response.status_code == 404:
+            # Hanya 404 yang pasti: token tidak punya invoice
+            return None, False
+        else:
+            # 5xx, 408, 429, 401 dan sejenisnya bisa sementara: jangan dianggap token ditolak
+            raise requests.exceptions.HTTPError(f"HTTP {response.status_code} untuk invoice {token}", response=response)
+
+        ttl = INVOICE_PAID_CACHE_TTL if invoice.get("isPaid", False) else INVOICE_CACHE_TTL
+        with invoice_cache_lock:
+            invoice_cache[token] = (
+                time.time() + ttl,
+                invoice,
+                response.headers.get("ETag") or (entry and entry[2]),
+                response.headers.get("Last-Modified") or (entry and entry[3])
+            )
+            invoice_cache.move_to_end(token)
+            while len(invoice_cache) > INVOICE_CACHE_SIZE:
+                invoice_cache.popitem(last=False)
+        return invoice, False
+    finally:
+        with invoice_cache_lock:
+            invoice_inflight.pop(token).set()
+
+def parse_created_at(value):
+    """Parse CreatedAt ISO-8601 dari API ("2024-01-31T08:15:30.123456Z") menjadi datetime UTC."""
+    try:
+        # Jalur cepat: fromisoformat jauh lebih murah daripada strptime
+        created_time = datetime.datetime.fromisoformat(value[:-1] if value.endswith("Z") else value)
+    except ValueError:
+        created_time = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    # Offset eksplisit (mis. +07:00) dikonversi; hanya waktu tanpa zona yang dianggap UTC
+    if created_time.tzinfo is not None:
+        return created_time.astimezone(datetime.timezone.utc)
+    return created_time.replace(tzinfo=datetime.timezone.utc)
+
+# Tabel denominasi
+def load_denominations():
+    """Membaca tabel denominasi dari DENOMINATION_FILE, atau default jika file tidak ada."""
+    if not os.path.exists(DENOMINATION_FILE):
+        return DEFAULT_DENOMINATIONS
+    with open(DENOMINATION_FILE) as f:
+        return json.load(f)["denominations"]
+
+def compile_denominations(denominations):
+    """Mengompilasi tabel denominasi menjadi lookup O(1) berindeks jumlah pulsa mentah."""
+    windows = []
+    for note in denominations:
+        pulses = int(note["pulses"])
+        low = int(note.get("min", pulses - note.get("tolerance", 0)))
+        high = int(note.get("max", pulses + note.get("tolerance", 0)))
+        if not 1 <= low <= pulses <= high:
+            raise ValueError(f"Jendela pulsa {low}-{high} tidak valid untuk {pulses} pulsa")
+        windows.append((low, high, pulses, int(note["nominal"])))
+
+    lookup = [(None, 0, "di luar toleransi")] * (max(high for _, high, _, _ in windows) + 1)
+    lookup[0] = (None, 0, "tidak ada pulsa")
+    for low, high, pulses, nominal in windows:
+        for raw in range(low, high + 1):
+            if lookup[raw][0] is not None:
+                raise ValueError(f"Jendela pulsa {raw} tumpang tindih antara {lookup[raw][0]} dan {pulses} pulsa")
+            lookup[raw] = (pulses, nominal, None)
+    return lookup
+
+try:
+    pulse_lookup = compile_denominations(load_denominations())
+except (OSError, ValueError, KeyError, TypeError) as e:
+    log_transaction(f"⚠️ Tabel denominasi tidak valid: {e}")
+    exit()
 
 # Inisialisasi pigpio
 pi = pigpio.pi()
@@ -74,15 +733,10 @@ if not pi.connected:
     log_transaction("⚠️ Gagal terhubung ke pigpio daemon!")
     exit()
 
-pi.set_mode(BILL_ACCEPTOR_PIN, pigpio.INPUT)
-pi.set_pull_up_down(BILL_ACCEPTOR_PIN, pigpio.PUD_UP)
-pi.set_mode(EN_PIN, pigpio.OUTPUT)
-pi.write(EN_PIN, 0)
-
 # Fungsi GET ke API Invoice
 def fetch_invoice_details():
     try:
-        response = requests.get(INVOICE_API, timeout=5)
+        response = api_request("invoice", "GET", INVOICE_API)
         response_data = response.json()
 
         if response.status_code == 200 and "data" in response_data:
@@ -97,20 +751,164 @@ def fetch_invoice_details():
 
     return None, None, None
 
+# Outbox settlement (SQLite WAL): settlement dicatat dulu, dikirim belakangan
+outbox_db = sqlite3.connect(OUTBOX_DB, check_same_thread=False, isolation_level=None)
+outbox_db.execute("PRAGMA journal_mode=WAL")
+outbox_db.execute("PRAGMA synchronous=FULL")
+outbox_db.execute("""
+    CREATE TABLE IF NOT EXISTS settlement_outbox (
+        idempotency_key TEXT PRIMARY KEY,
+        device_id TEXT,
+        trx_id NOT NULL,
+        payment_token TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        last_error TEXT
+    )
+""")
+outbox_db.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON settlement_outbox (status, next_attempt)")
+outbox_db.execute("CREATE INDEX IF NOT EXISTS outbox_token ON settlement_outbox (payment_token)")
+
+# Jurnal transaksi terstruktur (append-only, terindeks per waktu dan payment token)
+journal_db = sqlite3.connect(JOURNAL_DB, check_same_thread=False, isolation_level=None)
+journal_db.execute("PRAGMA journal_mode=WAL")
+journal_db.execute("PRAGMA synchronous=NORMAL")
+journal_db.execute("""
+    CREATE TABLE IF NOT EXISTS transaction_journal (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        device_id TEXT,
+        event TEXT NOT NULL,
+        trx_id,
+        payment_token TEXT,
+        amount INTEGER,
+        data TEXT
+    )
+""")
+journal_db.execute("CREATE INDEX IF NOT EXISTS journal_ts ON transaction_journal (ts)")
+journal_db.execute("CREATE INDEX IF NOT EXISTS journal_token ON transaction_journal (payment_token, ts)")
+journal_db.execute("CREATE INDEX IF NOT EXISTS journal_device ON transaction_journal (device_id, ts)")
+
+def journal_event(event, trx_id=None, token=None, amount=None, device_id=None, **data):
+    """Menambahkan satu record siklus transaksi ke jurnal (start, credit, settle, settlement, ...)."""
+    try:
+        with journal_lock:
+            journal_db.execute(
+                "INSERT INTO transaction_journal (ts, device_id, event, trx_id, payment_token, amount, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), device_id, event, trx_id, token, amount, json.dumps(data) if data else None)
+            )
+    except sqlite3.Error as e:
+        log_transaction(f"⚠️ Gagal menulis jurnal transaksi: {e}")
+
+def query_journal(since, until=None, token=None, event=None, limit=JOURNAL_QUERY_LIMIT, device_id=None):
+    """Range query jurnal memakai indeks; mengembalikan record dan total kredit dalam rentang."""
+    conditions = ["ts >= ?"]
+    params = [since]
+    if until is not None:
+        conditions.append("ts < ?")
+        params.append(until)
+    if token:
+        conditions.append("payment_token = ?")
+        params.append(token)
+    if device_id:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    where = " AND ".join(conditions)
+
+    with journal_lock:
+        if event:
+            rows = journal_db.execute(
+                f"SELECT seq, ts, device_id, event, trx_id, payment_token, amount, data FROM transaction_journal "
+                f"WHERE {where} AND event = ? ORDER BY ts LIMIT ?", (*params, event, limit)
+            ).fetchall()
+        else:
+            rows = journal_db.execute(
+                f"SELECT seq, ts, device_id, event, trx_id, payment_token, amount, data FROM transaction_journal "
+                f"WHERE {where} ORDER BY ts LIMIT ?", (*params, limit)
+            ).fetchall()
+        total_credit = journal_db.execute(
+            f"SELECT COALESCE(SUM(amount), 0) FROM transaction_journal WHERE {where} AND event = 'credit'", params
+        ).fetchone()[0]
+
+    records = []
+    for seq, ts, device_id_value, event_name, trx_id, payment_token_value, amount, data in rows:
+        records.append({
+            "seq": seq,
+            "time": datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat(),
+            "deviceId": device_id_value,
+            "event": event_name,
+            "ID": trx_id,
+            "paymentToken": payment_token_value,
+            "amount": amount,
+            **(json.loads(data) if data else {})
+        })
+    return records, total_credit
+
+def queue_settlement(trx_id, token, amount, device_id=None):
+    """Mencatat settlement ke outbox lokal secara durable, lalu membangunkan pengirim."""
+    key = uuid.uuid4().hex
+    now = time.time()
+    with outbox_lock:
+        outbox_db.execute(
+            "INSERT INTO settlement_outbox (idempotency_key, device_id, trx_id, payment_token, amount, created_at, next_attempt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, device_id, trx_id, token, amount, now, now)
+        )
+    log_transaction(f"[{device_id}] 📥 Settlement dicatat ke outbox: ID: {trx_id}, Token: {token}, Rp.{amount}")
+    network_core.notify_outbox()
+    return key
+
+def token_has_settlement(token):
+    """True jika token sudah punya settlement di outbox (terkirim atau masih antri), agar tidak dimulai ulang."""
+    with outbox_lock:
+        return outbox_db.execute(
+            "SELECT 1 FROM settlement_outbox WHERE payment_token = ? AND status != 'rejected' LIMIT 1", (token,)
+        ).fetchone() is not None
+
+def finish_outbox_entry(key, status, error=None):
+    """Menandai entri outbox selesai ('sent') atau ditolak permanen ('rejected')."""
+    with outbox_lock:
+        outbox_db.execute(
+            "UPDATE settlement_outbox SET status = ?, last_error = ? WHERE idempotency_key = ?",
+            (status, error, key)
+        )
+
+def record_settlement_result(device_id, status, created_at, trx_id=None, token=None):
+    """Metrik dan event hasil final settlement beserta latensinya sejak dicatat ke outbox."""
+    inc_metric("bill_settlement_results_total", device=device_id, status=status)
+    observe_metric("bill_settlement_latency_seconds", time.time() - created_at, device=device_id, status=status)
+    publish_event("settlement_result", device_id, status=status, id_trx=trx_id, payment_token=token)
+
+def retry_outbox_entry(key, attempts, error):
+    """Menjadwalkan ulang entri outbox dengan exponential backoff + jitter."""
+    delay = min(OUTBOX_RETRY_BASE * (2 ** attempts), OUTBOX_RETRY_MAX) * random.uniform(0.8, 1.2)
+    with outbox_lock:
+        outbox_db.execute(
+            "UPDATE settlement_outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE idempotency_key = ?",
+            (attempts + 1, time.time() + delay, error, key)
+        )
+    log_transaction(f"🔁 Settlement akan dikirim ulang dalam {delay:.0f} detik (percobaan {attempts + 1}): {error}",
+                    category="network", level="warning")
+
 # Fungsi POST hasil transaksi
-def send_transaction_status():
-    global total_inserted, transaction_active, last_pulse_received_time
+def send_transaction_status(key, device_id, trx_id, token, amount, attempts, created_at):
+    """Mengirim satu settlement dari outbox ke BILL_API dengan Idempotency-Key."""
     try:
-        response = requests.post(BILL_API, json={
-            "ID": id_trx,
-            "paymentToken": payment_token,
-            "productPrice": total_inserted
-        }, timeout=5)
+        response = api_request("bill", "POST", BILL_API, json={
+            "ID": trx_id,
+            "paymentToken": token,
+            "productPrice": amount
+        }, headers={"Idempotency-Key": key})
 
         if response.status_code == 200:
             res_data = response.json()
-            log_transaction(f"✅ Pembayaran sukses: {res_data.get('message')}, Waktu: {res_data.get('payment date')}")
-            reset_transaction() 
+            log_transaction(f"[{device_id}] ✅ Pembayaran sukses: {res_data.get('message')}, Waktu: {res_data.get('payment date')}")
+            finish_outbox_entry(key, "sent")
+            record_settlement_result(device_id, "sent", created_at, trx_id, token)
+            journal_event("settlement", trx_id, token, amount, device_id, status="sent", http_status=200)
 
         elif response.status_code == 400:
             try:
@@ -119,220 +917,1401 @@ def send_transaction_status():
             except ValueError:
                 error_message = response.text 
 
-            log_transaction(f"⚠️ Gagal ({response.status_code}): {error_message}")
+            log_transaction(f"[{device_id}] ⚠️ Gagal ({response.status_code}): {error_message}")
+
+            if "Payment already completed" in error_message:
+                log_transaction(f"[{device_id}] ✅ Pembayaran sudah selesai sebelumnya.")
+                finish_outbox_entry(key, "sent", error_message)
+                record_settlement_result(device_id, "sent", created_at, trx_id, token)
+                journal_event("settlement", trx_id, token, amount, device_id, status="sent", http_status=400, message=error_message)
+            else:
+                finish_outbox_entry(key, "rejected", error_message)
+                record_settlement_result(device_id, "rejected", created_at, trx_id, token)
+                journal_event("settlement", trx_id, token, amount, device_id, status="rejected", http_status=400, message=error_message)
+
+        else:
+            log_transaction(f"[{device_id}] ⚠️ Respon tidak terduga: {response.status_code}")
+            retry_outbox_entry(key, attempts, f"HTTP {response.status_code}")
+            inc_metric("bill_settlement_results_total", device=device_id, status="retry")
+            journal_event("settlement", trx_id, token, amount, device_id, status="retry", http_status=response.status_code)
+
+    except BackendUnavailable:
+        pass  # Entri tetap pending tanpa menambah percobaan, drain_outbox menunggu breaker
+    except requests.exceptions.RequestException as e:
+        log_transaction(f"[{device_id}] ⚠️ Gagal mengirim status transaksi: {e}", category="network", level="warning")
+        retry_outbox_entry(key, attempts, str(e))
+        inc_metric("bill_settlement_results_total", device=device_id, status="retry")
+        journal_event("settlement", trx_id, token, amount, device_id, status="retry", message=str(e))
+
+def next_outbox_entry():
+    """Entri outbox pending dengan jadwal kirim paling awal, atau None jika outbox kosong."""
+    with outbox_lock:
+        return outbox_db.execute(
+            "SELECT idempotency_key, device_id, trx_id, payment_token, amount, attempts, next_attempt, created_at FROM settlement_outbox "
+            "WHERE status = 'pending' ORDER BY next_attempt LIMIT 1"
+        ).fetchone()
+
+def decode_pulses(pulses):
+    """Dekode jumlah pulsa mentah menjadi (pulsa terkoreksi, nominal, alasan penolakan) dalam O(1)."""
+    if pulses >= len(pulse_lookup):
+        return None, 0, "melebihi tabel denominasi"
+    return pulse_lookup[pulses]
+
+# Kalibrasi timing pulsa per perangkat
+def train_end_threshold(gap_multiple, pulse_gap):
+    """Jeda (detik) yang menutup rangkaian pulsa: gap_multiple x periode pulsa, dibatasi TRAIN_END_MIN..SETTLE_TIME."""
+    return min(SETTLE_TIME, max(TRAIN_END_MIN, gap_multiple * pulse_gap))
+
+def train_intervals(trains, train_gap):
+    """Interval antar-tepi (mikrodetik) di dalam tiap rangkaian.
+
+    Rangkaian juga dipecah pada jeda >= train_gap (detik, ambang akhir rangkaian perangkat), jadi jeda
+    antar lembar dalam satu transaksi tidak ikut dihitung sebagai periode pulsa.
+    """
+    limit = train_gap * 1_000_000
+    intervals = []
+    for ticks in trains:
+        for previous, tick in zip(ticks, ticks[1:]):
+            interval = pigpio.tickDiff(previous, tick)
+            if interval < limit:
+                intervals.append(interval)
+    return intervals
+
+def fit_calibration(intervals):
+    """Menaksir debounce dan periode pulsa dari interval tepi mentah (termasuk pantulan kontak).
+
+    Interval jauh di bawah median dianggap pantulan; debounce diletakkan di tengah antara pantulan
+    terpanjang dan pulsa asli terpendek (p1), pulse_gap = p99 periode pulsa asli.
+    """
+    if len(intervals) < CALIBRATION_MIN_SAMPLES:
+        raise ValueError(f"sampel interval terlalu sedikit ({len(intervals)} < {CALIBRATION_MIN_SAMPLES})")
+
+    ordered = sorted(intervals)
+    median = ordered[len(ordered) // 2]
+    bounce_count = bisect.bisect_left(ordered, median * CALIBRATION_BOUNCE_RATIO)
+    genuine = ordered[bounce_count:]
+    shortest = genuine[int(len(genuine) * 0.01)]
+    longest = genuine[min(len(genuine) - 1, int(len(genuine) * 0.99))]
+    bounce_max = ordered[bounce_count - 1] if bounce_count else 0
+
+    return {
+        "debounce": round((bounce_max + shortest) / 2 / 1_000_000, 4),
+        "pulse_gap": round(longest / 1_000_000, 4),
+        "samples": len(ordered),
+        "bounces": bounce_count,
+        "median_interval": round(median / 1_000_000, 4),
+        "updated_at": time.time()
+    }
+
+def load_calibration():
+    if not os.path.exists(CALIBRATION_FILE):
+        return {}
+    with open(CALIBRATION_FILE) as f:
+        return json.load(f).get("devices", {})
+
+def save_calibration(device_id, calibration):
+    """Menyimpan hasil kalibrasi satu perangkat; file diganti secara atomik."""
+    calibrations = load_calibration()
+    calibrations[device_id] = calibration
+    temp_file = f"{CALIBRATION_FILE}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"devices": calibrations}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, CALIBRATION_FILE)
+
+def check_calibration(calibration):
+    """Guard rail: mengembalikan alasan penolakan, atau None jika kalibrasi aman dipakai."""
+    if calibration.get("samples", 0) < CALIBRATION_MIN_SAMPLES:
+        return f"sampel terlalu sedikit ({calibration.get('samples', 0)})"
+    for key, (low, high) in CALIBRATION_LIMITS.items():
+        if not low <= calibration[key] <= high:
+            return f"{key} {calibration[key]} di luar batas {low}-{high}"
+    if calibration["debounce"] >= calibration["pulse_gap"] * 0.8:
+        return f"debounce {calibration['debounce']} terlalu dekat dengan periode pulsa {calibration['pulse_gap']}"
+    return None
+
+# Fungsi capture tepi pulsa (satu pipe notifikasi untuk semua bill acceptor)
+def capture_edges_from_pipe(pipe, pin_devices):
+    """Membaca laporan level GPIO dari pipe notifikasi pigpio secara batch dan membagi tepi per perangkat."""
+    skip_flags = pigpio.NTFY_FLAGS_EVENT | pigpio.NTFY_FLAGS_ALIVE | pigpio.NTFY_FLAGS_WDOG
+    last_levels = {pin: pi.read(pin) for pin in pin_devices}
+    leftover = b""
+
+    while True:
+        chunk = pipe.read(NOTIFY_REPORT.size * NOTIFY_READ_REPORTS)
+        if not chunk:
+            log_transaction("⚠️ Pipe notifikasi pigpio tertutup!")
+            return
+
+        data = leftover + chunk
+        usable = len(data) - (len(data) % NOTIFY_REPORT.size)
+        leftover = data[usable:]
+
+        for _seqno, flags, tick, level in NOTIFY_REPORT.iter_unpack(data[:usable]):
+            if flags & skip_flags:
+                continue
+            for pin, device in pin_devices.items():
+                high = (level >> pin) & 1
+                if high and not last_levels[pin]:
+                    device.record_edge(pin, 1, tick)
+                last_levels[pin] = high
+
+def start_edge_capture():
+    """Memulai capture tepi: pipe notifikasi jika tersedia, fallback ke callback pigpio per pin."""
+    pin_devices = {device.pin: device for device in devices.values()}
+    try:
+        handle = pi.notify_open()
+        pipe = open(f"/dev/pigpio{handle}", "rb", buffering=0)
+    except (pigpio.error, OSError) as e:
+        log_transaction(f"⚠️ Pipe notifikasi tidak tersedia ({e}), memakai callback pigpio.")
+        for pin, device in pin_devices.items():
+            pi.callback(pin, pigpio.RISING_EDGE, device.record_edge)
+        return
+
+    pi.notify_begin(handle, sum(1 << pin for pin in pin_devices))
+    threading.Thread(target=capture_edges_from_pipe, args=(pipe, pin_devices), daemon=True).start()
+
+# Ekspor tepi mentah: .npy (structured array, bisa dibaca numpy.load) atau JSON lines untuk replay.py
+def encode_edges_npy(times, ticks, tags):
+    """Menyusun file NPY versi 1.0 dengan dtype RAW_EDGE_NPY_DESCR tanpa membutuhkan numpy."""
+    header = f"{{'descr': {RAW_EDGE_NPY_DESCR!r}, 'fortran_order': False, 'shape': ({len(times)},), }}"
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    body = b"".join(RAW_EDGE_RECORD.pack(*edge) for edge in zip(times, ticks, tags))
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1") + body
+
+def encode_edges_trace(times, ticks, tags, trx_tags, train_gap):
+    """Memecah tepi menjadi rangkaian pulsa (ganti transaksi atau jeda tick > train_gap detik), satu baris JSON per rangkaian.
+
+    train_gap adalah ambang akhir rangkaian perangkat, sama seperti pemecahan ekspor .npy di gpio_sim.load_edge_export.
+    """
+    gap_us = train_gap * 1_000_000
+    lines = []
+    train = None
+    for edge_time, tick, tag in zip(times, ticks, tags):
+        if train is None or tag != train["tag"] or pigpio.tickDiff(train["ticks"][-1], tick) > gap_us:
+            train = {"tag": tag, "start": edge_time, "ticks": []}
+            lines.append(train)
+        train["ticks"].append(tick)
+    return "".join(json.dumps({
+        "nominal": None,
+        "id_trx": trx_tags.get(train["tag"]),
+        "start": train["start"],
+        "ticks": train["ticks"]
+    }) + "\n" for train in lines)
+
+# Checkpoint transaksi aktif: dua slot bergantian dengan seq + CRC, slot yang sobek saat crash diabaikan
+def open_checkpoint(device_id):
+    path = CHECKPOINT_FILE.format(device_id=device_id)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < 2 * CHECKPOINT_SLOT_SIZE:
+            os.ftruncate(fd, 2 * CHECKPOINT_SLOT_SIZE)
+        return mmap.mmap(fd, 2 * CHECKPOINT_SLOT_SIZE)
+    finally:
+        os.close(fd)
+
+def read_checkpoint(checkpoint_map):
+    """Record valid dengan seq tertinggi sebagai dict, atau None jika file kosong/rusak."""
+    latest = None
+    for slot in range(2):
+        offset = slot * CHECKPOINT_SLOT_SIZE
+        body = checkpoint_map[offset:offset + CHECKPOINT_RECORD.size]
+        crc, = struct.unpack_from("<I", checkpoint_map, offset + CHECKPOINT_RECORD.size)
+        if zlib.crc32(body) != crc:
+            continue
+        magic, active, retry, seq, price, total, updated_at, trx_id, token = CHECKPOINT_RECORD.unpack(body)
+        if magic != CHECKPOINT_MAGIC or (latest is not None and seq <= latest["seq"]):
+            continue
+        try:
+            trx_id = json.loads(trx_id.rstrip(b"\0") or b"null")
+            token = token.rstrip(b"\0").decode("utf-8")
+        except ValueError:
+            continue  # Isi tidak bisa didekode: slot dianggap tidak valid, bukan menggagalkan startup
+        latest = {
+            "active": bool(active),
+            "insufficient_payment_count": retry,
+            "seq": seq,
+            "product_price": price,
+            "total_inserted": total,
+            "updated_at": updated_at,
+            "id_trx": trx_id,
+            "payment_token": token
+        }
+    return latest
+
+def write_checkpoint(checkpoint_map, seq, active, retry, price, total, trx_id, token):
+    """Menulis record ke slot seq % 2; slot lain tetap berisi record sebelumnya yang utuh.
+
+    ValueError jika id_trx atau token melebihi CHECKPOINT_FIELD_SIZE (struct akan memotongnya diam-diam).
+    """
+    trx_field = json.dumps(trx_id).encode("utf-8")
+    token_field = (token or "").encode("utf-8")
+    if len(trx_field) > CHECKPOINT_FIELD_SIZE or len(token_field) > CHECKPOINT_FIELD_SIZE:
+        raise ValueError(f"id_trx/payment token lebih dari {CHECKPOINT_FIELD_SIZE} byte")
+    body = CHECKPOINT_RECORD.pack(
+        CHECKPOINT_MAGIC, active, retry, seq, price, total, time.time(), trx_field, token_field
+    )
+    offset = (seq % 2) * CHECKPOINT_SLOT_SIZE
+    checkpoint_map[offset:offset + len(body) + 4] = body + struct.pack("<I", zlib.crc32(body))
+    if CHECKPOINT_SYNC:
+        checkpoint_map.flush()
+
+# Event stream kiosk (SSE): publisher tidak pernah menunggu klien
+def publish_event(event, device_id, snapshot=None, **data):
+    """Mengirim event ke semua klien SSE; antrian klien yang penuh dilewati."""
+    item = (next(event_seq), event, device_id, snapshot, data)
+    for subscriber in event_subscribers:
+        try:
+            subscriber.put_nowait(item)
+        except queue.Full:
+            pass
+
+def subscribe_events():
+    global event_subscribers
+    subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with event_subscribers_lock:
+        event_subscribers = event_subscribers + (subscriber,)
+    return subscriber
+
+def unsubscribe_events(subscriber):
+    global event_subscribers
+    with event_subscribers_lock:
+        event_subscribers = tuple(s for s in event_subscribers if s is not subscriber)
+
+def format_sse(seq, event, data):
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+# Snapshot status perangkat: objek immutable yang diganti utuh, dibaca tanpa lock
+DeviceSnapshot = collections.namedtuple("DeviceSnapshot", (
+    "device_id", "state", "status", "message", "id_trx", "payment_token", "product_price",
+    "total_inserted", "pending_pulses", "remaining_time", "updated_at"
+))
+
+# State machine transaksi
+class TransactionState(enum.Enum):
+    IDLE = "idle"
+    WAITING_TOKEN = "waiting_token"
+    ACCEPTING = "accepting"
+    SETTLING = "settling"
+
+# Konteks transaksi per bill acceptor
+class BillAcceptor:
+    """State machine transaksi milik satu bill acceptor; HTTP, log, outbox dan jurnal dipakai bersama.
+
+    Alur: IDLE -> WAITING_TOKEN -> ACCEPTING -> SETTLING -> IDLE, dijalankan oleh satu driver loop
+    (run). Thread lain hanya menambah pulsa (process_edges) atau token webhook, lalu membangunkan driver.
+    """
+
+    __slots__ = (
+        "device_id", "pin", "en_pin", "token_api", "state", "debounce", "pulse_gap", "gap_multiple", "train_gap_max",
+        "pending_pulse_count", "last_pulse_tick", "total_inserted", "id_trx", "payment_token",
+        "product_price", "last_pulse_received_time", "insufficient_payment_count",
+        "transaction_lock", "wakeup", "token_queue", "offers", "webhook_seen", "poll_interval", "next_poll_time",
+        "seen_tokens", "token_cursor",
+        "edge_ticks", "edge_write_count", "edge_read_count", "edge_event",
+        "snapshot", "snapshot_lock", "checkpoint_map", "checkpoint_seq",
+        "raw_times", "raw_ticks", "raw_tags", "raw_write_count", "trx_tag", "trx_tags"
+    )
+
+    def __init__(self, device_id, pin, en_pin, pulse_gap=ACCEPTOR_MODELS["default"]["pulse_gap"],
+                 gap_multiple=ACCEPTOR_MODELS["default"]["gap_multiple"]):
+        self.device_id = device_id
+        self.pin = pin
+        self.en_pin = en_pin
+        self.token_api = f"{TOKEN_API}{device_id}"
+        self.state = TransactionState.IDLE
+
+        # Timing acceptor untuk debounce dan deteksi akhir rangkaian pulsa (bisa diganti hasil kalibrasi)
+        self.debounce = DEBOUNCE_TIME
+        self.pulse_gap = pulse_gap
+        self.gap_multiple = gap_multiple
+        self.train_gap_max = 0
+
+        # State transaksi
+        self.pending_pulse_count = 0
+        self.last_pulse_tick = None
+        self.total_inserted = 0
+        self.id_trx = None
+        self.payment_token = None
+        self.product_price = 0
+        self.last_pulse_received_time = time.time()
+        self.insufficient_payment_count = 0
+        self.transaction_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        # Pencarian token: token webhook masuk ke network core, invoice siap pakai kembali lewat offers
+        self.token_queue = queue.Queue(maxsize=TOKEN_QUEUE_SIZE)
+        self.offers = queue.Queue()
+        self.webhook_seen = False
+        self.poll_interval = POLL_INTERVAL_MIN
+        self.next_poll_time = 0
+        self.seen_tokens = collections.OrderedDict()  # token -> CreatedAt, dibatasi TOKEN_SEEN_SIZE
+        self.token_cursor = None
+
+        # Ring buffer tick tepi naik dari pigpio (satu penulis, satu pembaca)
+        self.edge_ticks = array.array("I", [0] * EDGE_BUFFER_SIZE)
+        self.edge_write_count = 0
+        self.edge_read_count = 0
+        self.edge_event = threading.Event()
+
+        # Rekaman tepi mentah (waktu monotonic, tick, tag transaksi) untuk ekspor diagnosa.
+        # Monotonic agar ring tetap terurut saat jam dinding melompat (sinkron NTP setelah boot, Pi tanpa RTC)
+        self.raw_times = array.array("d", [0.0] * RAW_EDGE_BUFFER_SIZE)
+        self.raw_ticks = array.array("I", [0] * RAW_EDGE_BUFFER_SIZE)
+        self.raw_tags = array.array("I", [0] * RAW_EDGE_BUFFER_SIZE)
+        self.raw_write_count = 0
+        self.trx_tag = 0
+        self.trx_tags = collections.OrderedDict()  # tag -> id_trx
+
+        # Snapshot status untuk /api/status dan SSE
+        self.snapshot_lock = threading.Lock()
+        self.snapshot = None
+        self.update_snapshot()
+
+        # Checkpoint transaksi aktif untuk warm resume setelah crash/reboot
+        self.checkpoint_map = open_checkpoint(device_id)
+        self.checkpoint_seq = 0
+
+        pi.set_mode(pin, pigpio.INPUT)
+        pi.set_pull_up_down(pin, pigpio.PUD_UP)
+        pi.set_mode(en_pin, pigpio.OUTPUT)
+        pi.write(en_pin, 0)
+
+    @property
+    def transaction_active(self):
+        return self.state in (TransactionState.ACCEPTING, TransactionState.SETTLING)
+
+    def log(self, message, **kwargs):
+        log_transaction(f"[{self.device_id}] {message}", **kwargs)
+
+    def start(self):
+        """Menjalankan dua thread tetap milik perangkat: pemroses tepi dan driver state machine."""
+        self.resume_from_checkpoint()
+        for target in (self.process_edges, self.run):
+            threading.Thread(target=target, daemon=True).start()
+
+    def run(self):
+        """Driver loop tunggal: setiap handler state menunggu/bekerja lalu mengembalikan state berikutnya."""
+        handlers = {
+            TransactionState.IDLE: self.on_idle,
+            TransactionState.WAITING_TOKEN: self.on_waiting_token,
+            TransactionState.ACCEPTING: self.on_accepting,
+            TransactionState.SETTLING: self.on_settling
+        }
+        while True:
+            previous = self.state
+            try:
+                self.state = handlers[previous]()
+            except Exception as e:
+                self.state = self.recover(previous, e)
+            if self.state is not previous:
+                self.publish("state")
+
+    def recover(self, state, error):
+        """Error tak terduga di handler: EN_PIN dimatikan, lalu settle ulang jika sudah ada uang, selain itu IDLE."""
+        self.log(f"❌ Error di state {state.name}: {error!r}", level="error", summarize=True)
+        try:
+            pi.write(self.en_pin, 0)
+        except Exception as e:
+            self.log(f"❌ Gagal menonaktifkan EN_PIN: {e!r}", level="error", summarize=True)
+        time.sleep(DRIVER_ERROR_BACKOFF)
+
+        # Uang yang sudah masuk tidak boleh hilang: SETTLING dicoba lagi sampai settlement tercatat
+        if self.total_inserted > 0:
+            return TransactionState.SETTLING
+        try:
+            self.reset_transaction()
+        except Exception as e:
+            self.log(f"❌ Gagal reset transaksi: {e!r}", level="error", summarize=True)
+        return TransactionState.IDLE
+
+    def record_edge(self, gpio, level, tick):
+        """Menyimpan tick tepi naik ke ring buffer, tanpa logika lain di jalur callback."""
+        if level != 1:
+            return
+
+        self.edge_ticks[self.edge_write_count % EDGE_BUFFER_SIZE] = tick
+        self.edge_write_count += 1
+        self.edge_event.set()
+
+        slot = self.raw_write_count % RAW_EDGE_BUFFER_SIZE
+        self.raw_times[slot] = time.monotonic()
+        self.raw_ticks[slot] = tick
+        self.raw_tags[slot] = self.trx_tag if self.id_trx is not None else 0
+        self.raw_write_count += 1
+
+    def tag_transaction(self):
+        """Memberi tag baru untuk tepi mentah transaksi yang sedang berjalan."""
+        self.trx_tag = self.trx_tag % 0xFFFFFFFF + 1
+        self.trx_tags[self.trx_tag] = self.id_trx
+        while len(self.trx_tags) > RAW_EDGE_TRX_HISTORY:
+            self.trx_tags.popitem(last=False)
+
+    def raw_edges(self, since=None, until=None):
+        """Tepi mentah dalam rentang waktu epoch sebagai (times, ticks, tags) array, tanpa lock.
+
+        Ring diurutkan dengan jam monotonic; batas since/until dan times hasil dikonversi dari/ke epoch
+        memakai selisih jam dinding saat query. Hanya potongan yang diminta yang disalin; entri yang
+        tertimpa penulis selama penyalinan dibuang.
+        """
+        wall_offset = time.time() - time.monotonic()
+        end = self.raw_write_count
+        start = max(0, end - RAW_EDGE_BUFFER_SIZE)
+        position = lambda index: self.raw_times[index % RAW_EDGE_BUFFER_SIZE]
+        lo = start if since is None else bisect.bisect_left(range(start, end), since - wall_offset, key=position) + start
+        hi = end if until is None else bisect.bisect_right(range(start, end), until - wall_offset, key=position) + start
+
+        copies = []
+        for ring in (self.raw_times, self.raw_ticks, self.raw_tags):
+            first, last = lo % RAW_EDGE_BUFFER_SIZE, (hi - 1) % RAW_EDGE_BUFFER_SIZE + 1
+            if hi <= lo:
+                copies.append(ring[:0])
+            elif first < last:
+                copies.append(ring[first:last])
+            else:
+                copies.append(ring[first:] + ring[:last])
 
-            if "Insufficient payment" in error_message:
-                global insufficient_payment_count
-                insufficient_payment_count += 1 
+        # Slot yang sedang/sudah ditulis ulang sejak snapshot end tidak bisa dipercaya lagi
+        overwritten = max(0, self.raw_write_count - RAW_EDGE_BUFFER_SIZE + 1) - lo
+        if overwritten > 0:
+            copies = [copy[overwritten:] for copy in copies]
+        copies[0] = array.array("d", [stamp + wall_offset for stamp in copies[0]])
+        return tuple(copies)
 
-                if insufficient_payment_count > MAX_RETRY:
-                    log_transaction("🚫 Pembayaran kurang dan telah melebihi toleransi transaksi, transaksi dibatalkan!")
-                    reset_transaction()
-                    pi.write(EN_PIN, 1)
-                    transaction_active = False
+    def process_edges(self):
+        """Mengambil tick dari ring buffer lalu menjalankan debounce dan penghitungan pulsa."""
+        while True:
+            self.edge_event.wait()
+            self.edge_event.clear()
+
+            while self.edge_read_count < self.edge_write_count:
+                overrun = self.edge_write_count - self.edge_read_count - EDGE_BUFFER_SIZE
+                if overrun > 0:
+                    self.log(f"⚠️ Ring buffer pulsa penuh, {overrun} tepi terlewat!")
+                    self.edge_read_count += overrun
+                    continue
+
+                tick = self.edge_ticks[self.edge_read_count % EDGE_BUFFER_SIZE]
+                self.count_pulse(self.pin, 1, tick)
+                # Dinaikkan setelah count_pulse: driver tidak menutup rangkaian selama tepi belum terhitung
+                self.edge_read_count += 1
+
+    # Fungsi untuk menghitung pulsa
+    def count_pulse(self, gpio, level, tick):
+        """Menghitung pulsa dari bill acceptor dan mengonversinya ke nominal uang."""
+        if self.state is not TransactionState.ACCEPTING:
+            return
+
+        # Pastikan debounce berdasarkan tick pigpio (mikrodetik)
+        interval = None if self.last_pulse_tick is None else pigpio.tickDiff(self.last_pulse_tick, tick)
+        if interval is None or interval > self.debounce * 1_000_000:
+            inc_metric("bill_pulses_total", device=self.device_id)
+            if interval is not None and self.pending_pulse_count > 0:
+                observe_metric("bill_inter_pulse_interval_seconds", interval / 1_000_000, device=self.device_id)
+            with self.transaction_lock:
+                if self.pending_pulse_count == 0:
+                    pi.write(self.en_pin, 0)
+                    self.train_gap_max = 0
                 else:
-                    log_transaction(f"🔄 Pembayaran kurang, percobaan {insufficient_payment_count}/{MAX_RETRY}. Lanjutkan memasukkan uang...")
-                    last_pulse_received_time = time.time()
-                    transaction_active = True 
-                    pi.write(EN_PIN, 1)
-                    start_timeout_timer()
+                    self.train_gap_max = max(self.train_gap_max, interval)
+                self.pending_pulse_count += 1
+                self.last_pulse_tick = tick
+                self.last_pulse_received_time = time.time()
+            if CONSOLE_TRACE:
+                with print_lock:
+                    print(f"[{self.device_id}] 🔢 Pulsa diterima: {self.pending_pulse_count}")
+            self.publish("pulse")
+            if self.pending_pulse_count == 1:
+                # Awal rangkaian pulsa: driver perlu deadline settle yang baru
+                self.wakeup.set()
+        else:
+            inc_metric("bill_pulses_debounced_total", device=self.device_id)
+
+    # Handler state IDLE: transaksi sebelumnya sudah di-reset, minta network core mencari token dengan cadence cepat
+    def on_idle(self):
+        network_core.request_token(self)
+        return TransactionState.WAITING_TOKEN
+
+    # Handler state WAITING_TOKEN: menunggu invoice belum dibayar yang ditemukan network core (webhook atau polling)
+    def on_waiting_token(self):
+        token, invoice, from_cache = self.offers.get()
+        if self.begin_transaction(token, invoice, from_cache):
+            return TransactionState.ACCEPTING
+
+        network_core.request_token(self, reset=False)
+        return TransactionState.WAITING_TOKEN
+
+    def apply_calibration(self, calibration):
+        """Memakai debounce dan pulse_gap hasil kalibrasi jika lolos guard rail; False jika ditolak."""
+        reason = check_calibration(calibration)
+        if reason is not None:
+            self.log(f"⚠️ Kalibrasi ditolak: {reason}, tetap memakai debounce {self.debounce} dan pulse_gap {self.pulse_gap}")
+            return False
+        self.debounce = calibration["debounce"]
+        self.pulse_gap = calibration["pulse_gap"]
+        self.log(f"🎛️ Kalibrasi dipakai: debounce {self.debounce} detik, pulse_gap {self.pulse_gap} detik "
+                 f"({calibration['samples']} sampel)")
+        return True
+
+    def train_quiet_time(self):
+        """Jeda (detik) sejak pulsa terakhir menurut tick pigpio; tick yang di depan jam dianggap 0."""
+        elapsed = pigpio.tickDiff(self.last_pulse_tick, pi.get_current_tick())
+        return 0 if elapsed >= 1 << 31 else elapsed / 1_000_000
+
+    def train_end_time(self):
+        """Jeda (detik) yang menandai rangkaian pulsa selesai, dari periode pulsa terpanjang rangkaian ini."""
+        return train_end_threshold(self.gap_multiple, max(self.pulse_gap, self.train_gap_max / 1_000_000))
+
+    # Handler state ACCEPTING: bangun tepat pada deadline akhir rangkaian/settle/timeout, di-rearm oleh pulsa
+    def on_accepting(self):
+        # Tepi yang belum dibaca process_edges milik rangkaian yang sedang berjalan (mis. CPU sibuk):
+        # jangan menutup rangkaian, settle atau timeout sebelum semuanya terhitung
+        if self.edge_read_count != self.edge_write_count:
+            self.wakeup.wait(EDGE_DRAIN_WAIT)
+            self.wakeup.clear()
+            return TransactionState.ACCEPTING
+
+        current_time = time.time()
+        quiet_time = current_time - self.last_pulse_received_time
+        remaining_time = max(0, int(TIMEOUT - quiet_time))
+        train_end = self.train_end_time()
+        train_quiet = self.train_quiet_time() if self.pending_pulse_count > 0 else 0
+
+        if self.pending_pulse_count > 0 and train_quiet >= train_end:
+            self.process_final_pulse_count()
+            return TransactionState.ACCEPTING
+
+        if quiet_time >= SETTLE_TIME and self.total_inserted >= self.product_price:
+            pi.write(self.en_pin, 0)
+            overpaid = max(0, self.total_inserted - self.product_price)
+
+            if self.total_inserted == self.product_price:
+                self.log(f"✅ Transaksi selesai, total: Rp.{self.total_inserted}")
+            else:
+                self.log(f"✅ Transaksi selesai, kelebihan: Rp.{overpaid}")
+            return TransactionState.SETTLING
+
+        if quiet_time >= TIMEOUT:
+            # Timeout tercapai, hentikan transaksi
+            pi.write(self.en_pin, 0)
+            inc_metric("bill_transaction_timeouts_total", device=self.device_id)
+            remaining_due = max(0, self.product_price - self.total_inserted)
+            overpaid = max(0, self.total_inserted - self.product_price)
+
+            if self.total_inserted < self.product_price:
+                self.log(f"⏰ Timeout! Kurang: Rp.{remaining_due}")
+            elif self.total_inserted == self.product_price:
+                self.log(f"✅ Transaksi sukses, total: Rp.{self.total_inserted}")
+            else:
+                self.log(f"✅ Transaksi sukses, kelebihan: Rp.{overpaid}")
+            return TransactionState.SETTLING
+
+        if CONSOLE_TRACE:
+            with print_lock:
+                print(f"\r[{self.device_id}] ⏳ Timeout dalam {remaining_time} detik...", end="")
+        if remaining_time != self.snapshot.remaining_time:
+            self.publish("countdown")
+
+        # Deadline berikutnya: timeout, akhir rangkaian pulsa, settle (jika sudah lunas), atau detik countdown
+        next_deadline = TIMEOUT - quiet_time
+        if self.pending_pulse_count > 0:
+            next_deadline = min(next_deadline, train_end - train_quiet)
+        elif self.total_inserted >= self.product_price:
+            next_deadline = min(next_deadline, SETTLE_TIME - quiet_time)
+        self.wakeup.wait(min(next_deadline, (TIMEOUT - quiet_time) % 1 or 1))
+        self.wakeup.clear()
+        return TransactionState.ACCEPTING
+
+    # Handler state SETTLING: penyelesaian lokal tanpa menunggu jaringan
+    def on_settling(self):
+        if self.total_inserted < self.product_price:
+            self.insufficient_payment_count += 1
+            self.checkpoint()
+
+            if self.insufficient_payment_count <= MAX_RETRY:
+                inc_metric("bill_insufficient_payment_retries_total", device=self.device_id)
+                self.log(f"🔄 Pembayaran kurang, percobaan {self.insufficient_payment_count}/{MAX_RETRY}. Lanjutkan memasukkan uang...")
+                journal_event("retry", self.id_trx, self.payment_token, self.total_inserted, self.device_id,
+                              attempt=self.insufficient_payment_count, price=self.product_price)
+                self.last_pulse_received_time = time.time()
+                pi.write(self.en_pin, 1)
+                return TransactionState.ACCEPTING
+
+            self.log("🚫 Pembayaran kurang dan telah melebihi toleransi transaksi, transaksi dibatalkan!")
 
-            elif "Payment already completed" in error_message:
-                log_transaction("✅ Pembayaran sudah selesai sebelumnya. Reset transaksi.")
-                pi.write(EN_PIN, 0)  
+        # Uang yang sudah masuk selalu dicatat, termasuk transaksi yang dibatalkan
+        status = "queued" if self.total_inserted >= self.product_price else "cancelled"
+        inc_metric("bill_settlements_total", device=self.device_id, status=status)
+        journal_event("settle", self.id_trx, self.payment_token, self.total_inserted, self.device_id,
+                      status=status, price=self.product_price)
+        if self.total_inserted > 0:
+            queue_settlement(self.id_trx, self.payment_token, self.total_inserted, self.device_id)
+        self.publish("settlement", status=status, amount=self.total_inserted)
+        self.reset_transaction()
+        return TransactionState.IDLE
+
+    def process_final_pulse_count(self):
+        """Memproses pulsa yang terkumpul setelah rangkaian pulsa dianggap selesai (train_end_time)."""
+        with self.transaction_lock:
+            pulses, self.pending_pulse_count = self.pending_pulse_count, 0
+
+        if pulses == 0:
+            return
+
+        # Koreksi pulsa sesuai jendela toleransi tiap nominal
+        corrected_pulses, received_amount, reject_reason = decode_pulses(pulses)
+        inc_metric("bill_pulse_trains_total", device=self.device_id, raw=pulses, corrected=corrected_pulses or 0)
+
+        if corrected_pulses:
+            self.total_inserted += received_amount
+            self.checkpoint()
+            inc_metric("bill_credit_rupiah_total", received_amount, device=self.device_id)
+            remaining_due = max(self.product_price - self.total_inserted, 0)
+
+            self.log(f"💰 Koreksi pulsa: {pulses} -> {corrected_pulses} ({received_amount}) | Total: Rp.{self.total_inserted} | Sisa: Rp.{remaining_due}")
+            journal_event("credit", self.id_trx, self.payment_token, received_amount, self.device_id,
+                          raw_pulses=pulses, corrected_pulses=corrected_pulses, total=self.total_inserted)
+            self.publish("credit", amount=received_amount, raw_pulses=pulses)
 
         else:
-            log_transaction(f"⚠️ Respon tidak terduga: {response.status_code}")
+            self.log(f"⚠️ Pulsa {pulses} tidak valid! ({reject_reason})")
+            inc_metric("bill_pulse_trains_rejected_total", device=self.device_id, reason=reject_reason)
+            journal_event("invalid", self.id_trx, self.payment_token, None, self.device_id,
+                          raw_pulses=pulses, reason=reject_reason)
+            self.publish("credit", amount=0, raw_pulses=pulses, reason=reject_reason)
 
-    except requests.exceptions.RequestException as e:
-        log_transaction(f"⚠️ Gagal mengirim status transaksi: {e}")
-    reset_transaction()
-    trigger_transaction()
-        
-def closest_valid_pulse(pulses):
-    """Mendapatkan jumlah pulsa yang paling mendekati nilai yang valid."""
-    if pulses == 1:
-        return 1
-    if 2 < pulses < 5:
-        return 2
-    closest_pulse = min(PULSE_MAPPING.keys(), key=lambda x: abs(x - pulses) if x != 1 else float("inf"))
-    return closest_pulse if abs(closest_pulse - pulses) <= TOLERANCE else None
-
-# Fungsi untuk menghitung pulsa
-def count_pulse(gpio, level, tick):
-    """Menghitung pulsa dari bill acceptor dan mengonversinya ke nominal uang."""
-    global pulse_count, last_pulse_time, total_inserted, last_pulse_received_time, product_price, pending_pulse_count, timeout_thread
-
-    if not transaction_active:
-        return
+        pi.write(self.en_pin, 1)
+        if CONSOLE_TRACE:
+            with print_lock:
+                print(f"[{self.device_id}] ✅ Koreksi selesai, EN_PIN diaktifkan kembali")
+
+    # Reset transaksi setelah selesai
+    def reset_transaction(self):
+        self.total_inserted = 0
+        self.id_trx = None
+        self.payment_token = None
+        self.product_price = 0
+        self.last_pulse_received_time = time.time()
+        self.insufficient_payment_count = 0
+        self.pending_pulse_count = 0
+        self.checkpoint()
+        self.log("🔄 Transaksi di-reset ke default.")
+
+    def checkpoint(self):
+        """Menyimpan state transaksi aktif ke record mmap; murah, dipanggil di setiap perubahan kredit."""
+        try:
+            write_checkpoint(self.checkpoint_map, self.checkpoint_seq + 1, self.id_trx is not None,
+                             min(self.insufficient_payment_count, 255), self.product_price, self.total_inserted,
+                             self.id_trx, self.payment_token)
+        except ValueError as e:
+            self.log(f"⚠️ Checkpoint tidak ditulis ({e}), transaksi tidak bisa dilanjutkan setelah crash")
+            return
+        self.checkpoint_seq += 1
+
+    def resume_from_checkpoint(self):
+        """Menyambung kembali transaksi yang terputus crash/reboot sebelum driver berjalan.
+
+        Transaksi yang masih dalam jendela TIMEOUT dilanjutkan (EN_PIN aktif lagi), yang sudah lunas
+        atau kedaluwarsa langsung di-settle dengan uang yang sudah tercatat. Pulsa yang belum terhitung
+        saat crash tidak bisa dipulihkan.
+        """
+        record = read_checkpoint(self.checkpoint_map)
+        if record is None:
+            return
+        self.checkpoint_seq = record["seq"]
+        if not record["active"]:
+            return
+
+        token = record["payment_token"]
+        if token_has_settlement(token):
+            # Settlement sudah masuk outbox sebelum crash, tinggal membersihkan checkpoint
+            self.checkpoint()
+            return
+
+        self.id_trx = record["id_trx"]
+        self.payment_token = token
+        self.product_price = record["product_price"]
+        self.total_inserted = record["total_inserted"]
+        self.insufficient_payment_count = record["insufficient_payment_count"]
+        self.last_pulse_received_time = time.time()
+        self.tag_transaction()
+        age = time.time() - record["updated_at"]
+        journal_event("resume", self.id_trx, token, self.total_inserted, self.device_id,
+                      price=self.product_price, age=round(age, 3))
+
+        if self.total_inserted >= self.product_price:
+            self.log(f"♻️ Transaksi {self.id_trx} sudah lunas sebelum crash, langsung settle (Rp.{self.total_inserted})")
+            self.state = TransactionState.SETTLING
+        elif age <= TIMEOUT:
+            self.log(f"♻️ Melanjutkan transaksi {self.id_trx}: Rp.{self.total_inserted} dari Rp.{self.product_price}")
+            self.state = TransactionState.ACCEPTING
+            pi.write(self.en_pin, 1)
+        else:
+            # Pelanggan kemungkinan sudah pergi: settle tanpa percobaan ulang, uang yang masuk tetap dicatat
+            self.log(f"♻️ Transaksi {self.id_trx} kedaluwarsa ({age:.0f} detik), settle dengan Rp.{self.total_inserted}")
+            self.insufficient_payment_count = MAX_RETRY
+            self.state = TransactionState.SETTLING
+        self.publish("state")
+
+    def begin_transaction(self, token, invoice, from_cache=False):
+        """Masuk ke ACCEPTING untuk invoice yang sudah diambil jika belum dibayar."""
+        if invoice is not None:
+            if not invoice.get("isPaid", False):
+                self.payment_token = token
+                self.id_trx = invoice["ID"]
+                self.product_price = int(invoice["productPrice"])
+
+                self.pending_pulse_count = 0
+                self.last_pulse_received_time = time.time()
+                self.state = TransactionState.ACCEPTING
+                self.tag_transaction()
+                self.checkpoint()
+                self.log(f"🔔 Transaksi dimulai! ID: {self.id_trx}, Token: {self.payment_token}, Tagihan: Rp.{self.product_price}")
+                journal_event("start", self.id_trx, self.payment_token, self.product_price, self.device_id)
+                inc_metric("bill_transactions_started_total", device=self.device_id)
+                pi.write(self.en_pin, 1)
+                return True
+            elif not from_cache:
+                self.log(f"⚠️ Invoice {token} sudah dibayar, mencari lagi...")
+
+        return False
+
+    def mark_token_seen(self, token, created_at):
+        """Mengingat token yang sudah diproses agar tidak diparse dan dicek ulang di polling berikutnya."""
+        self.seen_tokens[token] = created_at
+        while len(self.seen_tokens) > TOKEN_SEEN_SIZE:
+            self.seen_tokens.popitem(last=False)
+
+    def push_token(self, token):
+        """Menyerahkan token dari webhook ke driver; False jika antrian penuh."""
+        try:
+            self.token_queue.put_nowait((token, time.time()))
+        except queue.Full:
+            return False
+        self.webhook_seen = True
+        network_core.wake_tokens(self)
+        return True
+
+    def update_snapshot(self):
+        """Membangun snapshot status baru; pembaca tetap memegang snapshot lama yang tidak berubah."""
+        active = self.transaction_active
+        remaining_time = None
+        if self.state is TransactionState.ACCEPTING:
+            remaining_time = max(0, int(TIMEOUT - (time.time() - self.last_pulse_received_time)))
 
-    current_time = time.time()
-
-    # Pastikan debounce
-    if (current_time - last_pulse_time) > DEBOUNCE_TIME:
-        if pending_pulse_count == 0:
-            pi.write(EN_PIN, 0)
-        pending_pulse_count += 1
-        last_pulse_time = current_time
-        last_pulse_received_time = current_time 
-        with print_lock:
-            print(f"🔢 Pulsa diterima: {pending_pulse_count}")  
-        if timeout_thread is None or not timeout_thread.is_alive():
-            timeout_thread = threading.Thread(target=start_timeout_timer, daemon=True)
-            timeout_thread.start()
-
-# Fungsi untuk menangani timeout & pembayaran sukses
-def start_timeout_timer():
-    global total_inserted, product_price, transaction_active, last_pulse_received_time, id_trx
-
-    with transaction_lock: 
-        while transaction_active:
-            current_time = time.time()
-            remaining_time = max(0, int(TIMEOUT - (current_time - last_pulse_received_time))) 
-            if (current_time - last_pulse_received_time) >= 2 and pending_pulse_count > 0:
-                    process_final_pulse_count()
+        with self.snapshot_lock:
+            self.snapshot = DeviceSnapshot(
+                self.device_id,
+                self.state.value,
+                "busy" if active else "ready",
+                "Bill acceptor sedang dalam transaksi" if active else "Bill acceptor siap digunakan",
+                self.id_trx,
+                self.payment_token,
+                self.product_price,
+                self.total_inserted,
+                self.pending_pulse_count,
+                remaining_time,
+                time.time()
+            )
+        return self.snapshot
+
+    def publish(self, event, **data):
+        """Memperbarui snapshot lalu mengirim event ke klien SSE."""
+        publish_event(event, self.device_id, self.update_snapshot(), **data)
+
+    def status(self):
+        """Status ringkas perangkat untuk /api/status, dari snapshot tanpa lock."""
+        return self.snapshot._asdict()
+
+class NetworkCore:
+    """Satu event loop asyncio pemilik semua I/O backend: polling token, lookup invoice dan outbox settlement.
+
+    Request tetap memakai session requests bersama, dijalankan di executor terbatas; loop yang mengatur
+    jadwal, batas waktu dan pembatalan. Invoice siap pakai diserahkan ke driver perangkat lewat
+    BillAcceptor.offers, sinyal dari thread lain masuk lewat call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=NETWORK_WORKERS, thread_name_prefix="network")
+        self.events = {}
+        self.invoice_slots = None
+        self.devices = ()
+
+    def start(self, devices):
+        self.devices = tuple(devices)
+        backend_breaker.listeners.append(self.on_breaker_change)
+        threading.Thread(target=self.loop.run_until_complete, args=(self.main(devices),), daemon=True).start()
+
+    async def main(self, devices):
+        self.invoice_slots = asyncio.Semaphore(INVOICE_FANOUT_WORKERS)
+        await asyncio.gather(self.drain_outbox(), *(self.serve_tokens(device) for device in devices))
+
+    # Sinyal dari thread lain (driver perangkat, Flask)
+    def event(self, name):
+        """asyncio.Event bernama, dibuat saat pertama dipakai di dalam loop."""
+        if name not in self.events:
+            self.events[name] = asyncio.Event()
+        return self.events[name]
+
+    def signal(self, name):
+        self.loop.call_soon_threadsafe(lambda: self.event(name).set())
+
+    def notify_outbox(self):
+        self.signal("outbox")
+
+    def wake_tokens(self, device):
+        self.signal(("wakeup", device.device_id))
+
+    def on_breaker_change(self, state):
+        """Dipanggil dari thread request: backend pulih berarti semua perangkat kembali ke cadence cepat."""
+        def changed():
+            for device in self.devices:
+                if state == "closed":
+                    device.poll_interval = POLL_INTERVAL_MIN
+                    device.next_poll_time = 0
+                self.event(("wakeup", device.device_id)).set()
+            self.event("outbox").set()
+        self.loop.call_soon_threadsafe(changed)
+
+    async def wait_backend(self, wakeup):
+        """Menunggu sampai breaker mengizinkan probe atau ada sinyal (mis. hasil probe)."""
+        try:
+            await asyncio.wait_for(wakeup.wait(), backend_breaker.retry_in())
+        except asyncio.TimeoutError:
+            pass
+
+    def request_token(self, device, reset=True):
+        """Driver siap menerima token; reset=True memulai ulang polling dengan cadence cepat."""
+        def wanted():
+            if reset:
+                device.poll_interval = POLL_INTERVAL_MIN
+                device.next_poll_time = 0
+            self.event(("wanted", device.device_id)).set()
+        self.loop.call_soon_threadsafe(wanted)
+
+    async def call(self, endpoint, func, *args, **kwargs):
+        """Menjalankan request blocking di executor dengan batas waktu total NETWORK_DEADLINES."""
+        future = self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, NETWORK_DEADLINES.get(endpoint))
+        except asyncio.TimeoutError:
+            raise requests.exceptions.Timeout(f"batas waktu {endpoint} {NETWORK_DEADLINES[endpoint]} detik terlampaui") from None
+
+    # Pencarian token per perangkat
+    def offer(self, device, token, invoice, from_cache):
+        """Menyerahkan invoice ke driver; mengembalikan False jika invoice tidak bisa dipakai."""
+        if invoice is None:
+            return False
+        if invoice.get("isPaid", False):
+            if not from_cache:
+                device.log(f"⚠️ Invoice {token} sudah dibayar, mencari lagi...", category="poll", summarize=True)
+            return False
+
+        self.event(("wanted", device.device_id)).clear()
+        device.offers.put((token, invoice, from_cache))
+        return True
+
+    async def fetch_invoice(self, token):
+        async with self.invoice_slots:
+            return await self.call("invoice", get_invoice, token)
+
+    async def offer_webhook_token(self, device, token, received_at):
+        device.log(f"📨 Token diterima dari webhook: {token}", category="poll")
+        # Settlement lokal bisa belum sampai ke backend, jadi invoice masih terlihat belum dibayar
+        if token_has_settlement(token):
+            return False
+        try:
+            # Token harus ada di daftar TOKEN_API perangkat ini; dicek paralel dengan lookup invoice
+            listed, (invoice, from_cache) = await asyncio.gather(self.token_listed(device, token), self.fetch_invoice(token))
+        except requests.exceptions.RequestException:
+            # Lookup gagal (termasuk breaker terbuka): token kembali ke antrian selama belum kedaluwarsa
+            if time.time() - received_at < TOKEN_MAX_AGE_MINUTES * 60:
+                try:
+                    device.token_queue.put_nowait((token, received_at))
+                except queue.Full:
+                    device.log(f"⚠️ Antrian token penuh, token webhook {token} menunggu polling", category="poll", level="warning")
+            raise
+        if not listed:
+            device.log(f"⚠️ Token webhook {token} tidak ada di daftar token perangkat ini, diabaikan", category="poll", level="warning")
+            return False
+        return self.offer(device, token, invoice, from_cache)
+
+    async def token_listed(self, device, token):
+        """True jika token ada di TOKEN_API perangkat, jadi invoice perangkat/kiosk lain tidak bisa dipakai."""
+        response = await self.call("token", api_request, "token", "GET", device.token_api)
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f"HTTP {response.status_code} saat memastikan token webhook", response=response)
+        return any(token_data.get("PaymentToken") == token for token_data in response.json().get("data", []))
+
+    async def serve_tokens(self, device):
+        """Token webhook diproses segera, polling TOKEN_API sebagai fallback dengan backoff."""
+        wanted = self.event(("wanted", device.device_id))
+        wakeup = self.event(("wakeup", device.device_id))
+
+        while True:
+            await wanted.wait()
+            wakeup.clear()
+
+            # Backend down: tidak polling dan token webhook tetap di antrian sampai breaker mengizinkan probe
+            if not backend_breaker.ready():
+                await self.wait_backend(wakeup)
+                continue
+
+            try:
+                offered = False
+                while not offered and not device.token_queue.empty():
+                    offered = await self.offer_webhook_token(device, *device.token_queue.get_nowait())
+                if offered:
                     continue
-            if (current_time - last_pulse_received_time) >= 2 and total_inserted >= product_price:
-                    transaction_active = False
-                    pi.write(EN_PIN, 0)  
-
-                    overpaid = max(0, total_inserted - product_price) 
-
-                    if total_inserted == product_price:
-                        log_transaction(f"✅ Transaksi selesai, total: Rp.{total_inserted}")
-                    else:
-                        log_transaction(f"✅ Transaksi selesai, kelebihan: Rp.{overpaid}")
-
-                    # Kirim status transaksi
-                    send_transaction_status()
-                    trigger_transaction()
-            if remaining_time == 0:
-                    # imeout tercapai, hentikan transaksi
-                    transaction_active = False
-                    pi.write(EN_PIN, 0) 
-
-                    remaining_due = max(0, product_price - total_inserted)
-                    overpaid = max(0, total_inserted - product_price) 
-
-                    if total_inserted < product_price:
-                        log_transaction(f"⏰ Timeout! Kurang: Rp.{remaining_due}")
-                    elif total_inserted == product_price:
-                        log_transaction(f"✅ Transaksi sukses, total: Rp.{total_inserted}")
-                    else:
-                        log_transaction(f"✅ Transaksi sukses, kelebihan: Rp.{overpaid}")
-                    send_transaction_status()
-                    transaction_active = False
-                    trigger_transaction()
-                    break
-            with print_lock:    
-                print(f"\r⏳ Timeout dalam {remaining_time} detik...", end="")
-            time.sleep(1)
-
-def process_final_pulse_count():
-    """Memproses pulsa yang terkumpul setelah tidak ada pulsa masuk selama 2 detik."""
-    global pending_pulse_count, total_inserted, pulse_count
-
-    if pending_pulse_count == 0:
-        return
 
-    # Koreksi pulsa dengan toleransi ±2
-    corrected_pulses = closest_valid_pulse(pending_pulse_count)
+                if time.time() >= device.next_poll_time:
+                    if await self.poll_tokens(device):
+                        continue
 
-    if corrected_pulses:
-        received_amount = PULSE_MAPPING.get(corrected_pulses, 0)
-        total_inserted += received_amount
-        remaining_due = max(product_price - total_inserted, 0)
+                    # Backoff hanya jika webhook sudah terbukti aktif; tanpa webhook tetap polling cepat
+                    if not device.webhook_seen:
+                        device.poll_interval = POLL_INTERVAL_MIN
+                    self.schedule_poll(device)
 
-        log_transaction(f"💰 Koreksi pulsa: {pending_pulse_count} -> {corrected_pulses} ({received_amount}) | Total: Rp.{total_inserted} | Sisa: Rp.{remaining_due}")
-    
-    else:
-        log_transaction(f"⚠️ Pulsa {pending_pulse_count} tidak valid!")
-
-    pending_pulse_count = 0 
-    pi.write(EN_PIN, 1)
-    with print_lock:
-        print("✅ Koreksi selesai, EN_PIN diaktifkan kembali")
-
-# Reset transaksi setelah selesai
-def reset_transaction():
-    global transaction_active, total_inserted, id_trx, payment_token, product_price, last_pulse_received_time, insufficient_payment_count, pending_pulse_count
-    transaction_active = False
-    total_inserted = 0
-    id_trx = None
-    payment_token = None
-    product_price = 0
-    last_pulse_received_time = time.time()  
-    insufficient_payment_count = 0  
-    pending_pulse_count = 0  
-    log_transaction("🔄 Transaksi di-reset ke default.")
+            except BackendUnavailable:
+                continue  # Kalah dari probe perangkat lain; sudah dicatat oleh circuit breaker
+            except requests.exceptions.RequestException as e:
+                if backend_breaker.state == "closed":
+                    device.log(f"⚠️ Gagal mengambil daftar payment token: {e}", category="poll", level="warning", summarize=True)
+                    self.schedule_poll(device)
+                else:
+                    device.next_poll_time = 0  # Jadwal probe berikutnya diatur circuit breaker
+            except Exception as e:
+                # Error tak terduga tidak boleh menghentikan loop jaringan (dan outbox settlement) semua perangkat
+                device.log(f"❌ Error tak terduga saat mencari token: {e!r}", category="poll", level="error", summarize=True)
+                self.schedule_poll(device)
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), max(0, device.next_poll_time - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def schedule_poll(self, device):
+        device.next_poll_time = time.time() + device.poll_interval
+        device.poll_interval = min(device.poll_interval * 2, POLL_INTERVAL_MAX)
+
+    async def poll_tokens(self, device):
+        """Satu kali polling TOKEN_API perangkat; mengembalikan True jika invoice diserahkan ke driver.
+
+        Hanya token yang belum pernah dilihat yang diparse dan dicek. Bila TOKEN_CURSOR_PARAM diset,
+        API diminta mengirim token yang lebih baru dari cursor saja.
+        """
+        device.log("🔍 Mencari payment token terbaru...", category="poll", summarize=True)
+
+        params = {TOKEN_CURSOR_PARAM: device.token_cursor} if TOKEN_CURSOR_PARAM and device.token_cursor else None
+        response = await self.call("token", api_request, "token", "GET", device.token_api, params=params)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        response_data = response.json()
+
+        if response.status_code == 200 and "data" in response_data:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            fresh_tokens = []
+            newest = device.token_cursor
+            for token_data in response_data["data"]:
+                try:
+                    token = token_data["PaymentToken"]
+                    if token in device.seen_tokens:
+                        continue
+                    created_at = token_data["CreatedAt"]
+                    age_in_minutes = (now - parse_created_at(created_at)).total_seconds() / 60
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    device.log(f"⚠️ Data token tidak valid dilewati: {token_data!r} ({e!r})", category="poll", level="warning", summarize=True)
+                    continue
+
+                if age_in_minutes <= TOKEN_MAX_AGE_MINUTES:
+                    fresh_tokens.append((token, created_at, age_in_minutes))
+                else:
+                    device.mark_token_seen(token, created_at)
+                if newest is None or created_at > newest:
+                    newest = created_at
+
+            # Settlement lokal bisa belum sampai ke backend, jadi invoice masih terlihat belum dibayar
+            for token, created_at, _ in fresh_tokens:
+                if token_has_settlement(token):
+                    device.mark_token_seen(token, created_at)
+            fresh_tokens = [entry for entry in fresh_tokens if entry[0] not in device.seen_tokens]
+
+            # Semua invoice diminta paralel, lalu diperiksa berurutan dari token yang paling dulu dibuat
+            fresh_tokens.sort(key=lambda entry: entry[1])
+            lookups = [asyncio.ensure_future(self.fetch_invoice(token)) for token, _, _ in fresh_tokens]
+            error = None
+            try:
+                for index, (token, created_at, age_in_minutes) in enumerate(fresh_tokens):
+                    device.log(f"✅ Token ditemukan: {token}, umur: {age_in_minutes:.2f} menit", category="poll")
+                    try:
+                        invoice, from_cache = await lookups[index]
+                    except requests.exceptions.RequestException as e:
+                        device.log(f"❌ Gagal mengambil invoice {token}: {e}", category="poll", level="warning")
+                        error = error or e
+                        continue
+
+                    device.mark_token_seen(token, created_at)
+                    if self.offer(device, token, invoice, from_cache):
+                        return True
+            finally:
+                # Lookup yang masih antri dibatalkan; request yang sudah jalan hanya mengisi cache
+                for lookup in lookups:
+                    lookup.cancel()
+
+            # Token yang gagal diambil dicoba lagi di polling berikutnya (cursor tidak maju)
+            if error is not None:
+                raise error
+
+            # Cursor hanya maju setelah semua token di respons selesai diproses
+            device.token_cursor = newest
+
+        device.log("✅ Tidak ada payment token yang memenuhi syarat. Menunggu...", category="poll", summarize=True)
+        return False
+
+    # Outbox settlement
+    async def drain_outbox(self):
+        """Menguras outbox settlement, tidak pernah menahan transaksi berikutnya."""
+        wakeup = self.event("outbox")
+        while True:
+            try:
+                await self.drain_outbox_step(wakeup)
+            except Exception as e:
+                # Error tak terduga (mis. sqlite) tidak boleh menghentikan loop jaringan; entri dicoba lagi nanti
+                log_transaction(f"❌ Error tak terduga di outbox settlement: {e!r}", category="network", level="error", summarize=True)
+                await asyncio.sleep(OUTBOX_RETRY_BASE)
+
+    async def drain_outbox_step(self, wakeup):
+        """Satu langkah outbox: menunggu entri/jadwal/breaker, atau mengirim satu entri yang sudah jatuh tempo."""
+        wakeup.clear()
+        row = next_outbox_entry()
+        if row is None:
+            await wakeup.wait()
+            return
+
+        if not backend_breaker.ready():
+            await self.wait_backend(wakeup)
+            return
+
+        key, device_id, trx_id, token, amount, attempts, next_attempt, created_at = row
+        delay = next_attempt - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        # Tanpa batas waktu loop: entri yang sama tidak boleh dikirim dua kali bersamaan
+        await self.loop.run_in_executor(self.executor, send_transaction_status,
+                                        key, device_id, trx_id, token, amount, attempts, created_at)
+
+network_core = NetworkCore()
+
+# Daftar perangkat
+def load_devices():
+    """Membaca daftar bill acceptor dari DEVICE_FILE, atau satu perangkat default jika file tidak ada."""
+    if not os.path.exists(DEVICE_FILE):
+        return DEFAULT_DEVICES
+    with open(DEVICE_FILE) as f:
+        return json.load(f)["devices"]
+
+try:
+    device_configs = load_devices()
+    used_pins = [pin for config in device_configs for pin in (config["pin"], config["en_pin"])]
+    if len(set(used_pins)) != len(used_pins):
+        raise ValueError("pin GPIO dipakai lebih dari satu kali")
+    if len({config["device_id"] for config in device_configs}) != len(device_configs):
+        raise ValueError("device_id harus unik")
+    device_timings = {}
+    for config in device_configs:
+        model = config.get("model", "default")
+        if model not in ACCEPTOR_MODELS:
+            raise ValueError(f"model acceptor {model} tidak dikenal")
+        timing = {key: float(config.get(key, value)) for key, value in ACCEPTOR_MODELS[model].items()}
+        if timing["pulse_gap"] <= DEBOUNCE_TIME or timing["gap_multiple"] < 1:
+            raise ValueError(f"timing pulsa {config['device_id']} tidak valid: {timing}")
+        device_timings[config["device_id"]] = timing
+except (OSError, ValueError, KeyError, TypeError) as e:
+    log_transaction(f"⚠️ Konfigurasi perangkat tidak valid: {e}")
+    exit()
+
+for config in device_configs:
+    devices[config["device_id"]] = BillAcceptor(config["device_id"], int(config["pin"]), int(config["en_pin"]),
+                                                **device_timings[config["device_id"]])
+
+try:
+    for device_id, calibration in load_calibration().items():
+        if device_id in devices:
+            devices[device_id].apply_calibration(calibration)
+except (OSError, ValueError, KeyError, TypeError) as e:
+    log_transaction(f"⚠️ File kalibrasi tidak valid, memakai timing default: {e}")
+
+def find_device(device_id=None):
+    """Mencari perangkat berdasarkan device_id; tanpa device_id hanya valid jika ada satu perangkat."""
+    if device_id is None:
+        return next(iter(devices.values())) if len(devices) == 1 else None
+    return devices.get(device_id)
 
 @app.route('/api/status', methods=['GET'])
 def get_bill_acceptor_status():
-    global transaction_active
-    
-    if transaction_active:
+    device_status = [device.status() for device in devices.values()]
+
+    if all(device["status"] == "busy" for device in device_status):
         return jsonify({
             "status": "error",
-            "message": "Bill acceptor sedang dalam transaksi"
-        }), 409 
+            "message": "Bill acceptor sedang dalam transaksi",
+            "devices": device_status,
+            "backend": backend_breaker.status()
+        }), 409
 
     return jsonify({
         "status": "success",
-        "message": "Bill acceptor siap digunakan"
-    }), 200 
+        "message": "Bill acceptor siap digunakan",
+        "devices": device_status,
+        "backend": backend_breaker.status()
+    }), 200
 
-def trigger_transaction():
-    global transaction_active, total_inserted, id_trx, payment_token, product_price, last_pulse_received_time, pending_pulse_count
-    
-    while True:
-        if transaction_active:
-            time.sleep(1) 
-            continue
+@app.route('/api/status/<device_id>', methods=['GET'])
+def get_device_status(device_id):
+    device = find_device(device_id)
+    if device is None:
+        return jsonify({
+            "status": "error",
+            "message": "Perangkat tidak ditemukan"
+        }), 404
+
+    device_status = device.status()
+    if device_status["status"] == "busy":
+        return jsonify({"status": "error", **device_status}), 409
+    return jsonify({"status": "success", **device_status}), 200
 
-        log_transaction("🔍 Mencari payment token terbaru...")
-        
+@app.route('/api/events', methods=['GET'])
+@app.route('/api/events/<device_id>', methods=['GET'])
+def stream_events(device_id=None):
+    """Server-Sent Events: snapshot awal per perangkat, lalu event pulse/credit/countdown/settlement."""
+    if device_id is not None and find_device(device_id) is None:
+        return jsonify({
+            "status": "error",
+            "message": "Perangkat tidak ditemukan"
+        }), 404
+
+    if len(event_subscribers) >= EVENT_MAX_CLIENTS:
+        return jsonify({
+            "status": "error",
+            "message": "Klien event stream penuh"
+        }), 503
+
+    subscriber = subscribe_events()
+
+    def generate():
         try:
-            response = requests.get(TOKEN_API, timeout=1)
-            response_data = response.json()
-
-            if response.status_code == 200 and "data" in response_data:
-                for token_data in response_data["data"]:
-                    created_time = datetime.datetime.strptime(token_data["CreatedAt"], "%Y-%m-%dT%H:%M:%S.%fZ") 
-                    created_time = created_time.replace(tzinfo=datetime.timezone.utc) 
-                    age_in_minutes = (datetime.datetime.now(datetime.timezone.utc) - created_time).total_seconds() / 60
-                    
-                    if age_in_minutes <= 3:  
-                        payment_token = token_data["PaymentToken"]
-                        log_transaction(f"✅ Token ditemukan: {payment_token}, umur: {age_in_minutes:.2f} menit")
-
-                        # Ambil detail invoice berdasarkan paymentToken
-                        invoice_response = requests.get(f"{INVOICE_API}{payment_token}", timeout=5)
-                        invoice_data = invoice_response.json()
-
-                        if invoice_response.status_code == 200 and "data" in invoice_data:
-                            invoice = invoice_data["data"]
-                            if not invoice.get("isPaid", False):
-                                id_trx = invoice["ID"]
-                                product_price = int(invoice["productPrice"])
-
-                                transaction_active = True
-                                pending_pulse_count = 0 
-                                last_pulse_received_time = time.time()
-                                log_transaction(f"🔔 Transaksi dimulai! ID: {id_trx}, Token: {payment_token}, Tagihan: Rp.{product_price}")
-                                pi.write(EN_PIN, 1)
-                                threading.Thread(target=start_timeout_timer, daemon=True).start()
-                                return
-                            else:
-                                log_transaction(f"⚠️ Invoice {payment_token} sudah dibayar, mencari lagi...")
-
-            log_transaction("✅ Tidak ada payment token yang memenuhi syarat. Menunggu...")
-            time.sleep(1)
-
-        except requests.exceptions.RequestException as e:
-            log_transaction(f"⚠️ Gagal mengambil daftar payment token: {e}")
-            time.sleep(1)
+            for device in devices.values():
+                if device_id is None or device.device_id == device_id:
+                    yield format_sse(0, "snapshot", {"device_id": device.device_id, "snapshot": device.snapshot._asdict()})
+
+            while True:
+                try:
+                    seq, event, event_device, snapshot, data = subscriber.get(timeout=EVENT_HEARTBEAT)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                if device_id is not None and event_device != device_id:
+                    continue
+                payload = {"device_id": event_device, **data}
+                if snapshot is not None:
+                    payload["snapshot"] = snapshot._asdict()
+                yield format_sse(seq, event, payload)
+        finally:
+            unsubscribe_events(subscriber)
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/api/http-stats', methods=['GET'])
+def get_http_stats():
+    return jsonify({
+        "status": "success",
+        "data": http_latency_stats()
+    }), 200
+
+def parse_query_time(value, default=None):
+    """Parameter waktu query: epoch detik atau ISO-8601 (tanpa zona dianggap waktu lokal)."""
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+@app.route('/api/transactions', methods=['GET'])
+def get_transactions():
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    try:
+        since = parse_query_time(request.args.get("since"), today)
+        until = parse_query_time(request.args.get("until"))
+        limit = min(int(request.args.get("limit", JOURNAL_QUERY_LIMIT)), JOURNAL_QUERY_LIMIT)
+        if limit < 1:
+            raise ValueError("limit harus minimal 1")  # SQLite LIMIT negatif berarti tanpa batas
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Parameter since/until/limit tidak valid"
+        }), 400
+
+    records, total_credit = query_journal(since, until, request.args.get("token"), request.args.get("event"), limit,
+                                          request.args.get("device"))
+    return jsonify({
+        "status": "success",
+        "total_credit": total_credit,
+        "data": records
+    }), 200
+
+@app.route('/api/debug/edges/<device_id>', methods=['GET'])
+def export_raw_edges(device_id):
+    """Ekspor tepi mentah perangkat dalam rentang since/until: format=npy (default) atau format=trace."""
+    device = find_device(device_id)
+    if device is None:
+        return jsonify({
+            "status": "error",
+            "message": "Perangkat tidak ditemukan"
+        }), 404
+
+    try:
+        since = parse_query_time(request.args.get("since"))
+        until = parse_query_time(request.args.get("until"))
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Parameter since/until tidak valid"
+        }), 400
+
+    times, ticks, tags = device.raw_edges(since, until)
+    used_tags = set(tags)
+    trx_tags = {tag: trx for tag, trx in list(device.trx_tags.items()) if tag in used_tags}
+    filename = f"edges-{device.device_id}-{int(times[0]) if times else 0}"
+
+    if request.args.get("format", "npy") == "trace":
+        train_gap = train_end_threshold(device.gap_multiple, device.pulse_gap)
+        return Response(encode_edges_trace(times, ticks, tags, trx_tags, train_gap), mimetype="application/x-ndjson", headers={
+            "Content-Disposition": f"attachment; filename={filename}.jsonl"
+        })
+
+    return Response(encode_edges_npy(times, ticks, tags), mimetype="application/octet-stream", headers={
+        "Content-Disposition": f"attachment; filename={filename}.npy",
+        "X-Edge-Transactions": json.dumps({str(tag): trx for tag, trx in trx_tags.items()})
+    })
+
+@app.route('/api/debug/calibration/<device_id>', methods=['GET', 'POST'])
+def calibrate_device(device_id):
+    """Kalibrasi dari tepi mentah live: GET hanya menaksir, POST juga menyimpan dan langsung memakai hasilnya."""
+    device = find_device(device_id)
+    if device is None:
+        return jsonify({
+            "status": "error",
+            "message": "Perangkat tidak ditemukan"
+        }), 404
+
+    try:
+        times, ticks, tags = device.raw_edges(parse_query_time(request.args.get("since")))
+        trains = []
+        for index, tick in enumerate(ticks):
+            if index == 0 or tags[index] != tags[index - 1]:
+                trains.append([])
+            trains[-1].append(tick)
+        calibration = fit_calibration(train_intervals(trains, train_end_threshold(device.gap_multiple, device.pulse_gap)))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 422
+
+    current = {"debounce": device.debounce, "pulse_gap": device.pulse_gap}
+    if request.method == "POST":
+        if not device.apply_calibration(calibration):
+            return jsonify({
+                "status": "error",
+                "message": f"Kalibrasi ditolak: {check_calibration(calibration)}",
+                "calibration": calibration,
+                "current": current
+            }), 422
+        save_calibration(device.device_id, calibration)
+
+    return jsonify({
+        "status": "success",
+        "calibration": calibration,
+        "current": current,
+        "rejected": check_calibration(calibration)
+    }), 200
+
+@app.route('/api/invoice', methods=['POST'])
+@app.route('/api/invoice/<device_id>', methods=['POST'])
+def receive_invoice_webhook(device_id=None):
+    """Menerima payment token baru dari backend agar transaksi langsung dimulai (hanya jika BILL_WEBHOOK_TOKEN diset)."""
+    if not WEBHOOK_TOKEN:
+        return jsonify({
+            "status": "error",
+            "message": "Webhook tidak aktif, BILL_WEBHOOK_TOKEN belum diset"
+        }), 403
+
+    if not hmac.compare_digest(request.headers.get("X-Webhook-Token", "").encode("utf-8"), WEBHOOK_TOKEN.encode("utf-8")):
+        return jsonify({
+            "status": "error",
+            "message": "Token webhook tidak valid"
+        }), 401
+
+    data = request.get_json(silent=True) or {}
+    token = data.get("paymentToken") or data.get("PaymentToken")
+    if not token:
+        return jsonify({
+            "status": "error",
+            "message": "paymentToken wajib diisi"
+        }), 400
+
+    device = find_device(device_id or data.get("deviceId"))
+    if device is None:
+        return jsonify({
+            "status": "error",
+            "message": "Perangkat tidak ditemukan"
+        }), 404
+
+    if device.transaction_active:
+        return jsonify({
+            "status": "error",
+            "message": "Bill acceptor sedang dalam transaksi"
+        }), 409
+
+    if not device.push_token(token):
+        return jsonify({
+            "status": "error",
+            "message": "Antrian token penuh"
+        }), 503
+
+    return jsonify({
+        "status": "success",
+        "message": "Payment token diterima"
+    }), 202
+
+def start_background_workers():
+    """Menjalankan network core (polling token, invoice, outbox settlement) untuk semua perangkat."""
+    network_core.start(devices.values())
 
 if __name__ == "__main__":
-    pi.callback(BILL_ACCEPTOR_PIN, pigpio.RISING_EDGE, count_pulse)
-    threading.Thread(target=trigger_transaction, daemon=True).start()
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+    start_edge_capture()
+    for device in devices.values():
+        device.start()
+    start_background_workers()
+    if waitress_serve is not None:
+        waitress_serve(app, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS)
+    else:
+        log_transaction("⚠️ waitress tidak terpasang, memakai server pengembangan Flask")
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False, use_reloader=False, threaded=True)
@@ -0,0 +1,107 @@
+"""Replay korpus rekaman pulsa ke logika decode new.py memakai backend GPIO simulasi.
+
+Contoh:
+    python replay.py korpus.jsonl                  # decode secepat mungkin (count_pulse + process_final_pulse_count)
+    python replay.py korpus.jsonl --realtime       # lewat callback, ring buffer dan driver state machine
+    python replay.py korpus.jsonl --realtime --speed 0   # realtime tanpa jeda antar pulsa
+    python replay.py edges-bic01.npy               # ekspor /api/debug/edges (tanpa label nominal)
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ["BILL_GPIO_BACKEND"] = "sim"
+os.environ.setdefault("BILL_LOG_DIR", tempfile.mkdtemp(prefix="billacceptor-log-"))
+os.environ.setdefault("BILL_DATA_DIR", tempfile.mkdtemp(prefix="billacceptor-data-"))
+
+import gpio_sim
+import new
+
+def prepare_device(device):
+    """Menyiapkan perangkat dalam state ACCEPTING dengan tagihan tak terjangkau agar tidak settle."""
+    device.reset_transaction()
+    device.id_trx = "replay"
+    device.payment_token = "replay"
+    device.product_price = 10 ** 12
+    device.last_pulse_received_time = time.time()
+    device.state = new.TransactionState.ACCEPTING
+
+def replay_decode(device, notes):
+    """Memutar setiap lembar langsung ke count_pulse lalu process_final_pulse_count, tanpa menunggu."""
+    results = []
+    prepare_device(device)
+    for note in notes:
+        before = device.total_inserted
+        device.last_pulse_tick = None
+        start = time.perf_counter()
+        for tick in note["ticks"]:
+            device.count_pulse(device.pin, 1, tick)
+        device.process_final_pulse_count()
+        results.append((note["nominal"], device.total_inserted - before, time.perf_counter() - start))
+    return results
+
+def replay_realtime(device, notes, speed):
+    """Memutar tepi lewat callback pigpio simulasi; latensi = tepi terakhir sampai EN_PIN aktif kembali."""
+    results = []
+    new.TIMEOUT = 10 ** 9
+    prepare_device(device)
+    new.start_edge_capture()
+    threading.Thread(target=device.process_edges, daemon=True).start()
+    threading.Thread(target=device.run, daemon=True).start()
+
+    for note in notes:
+        before = device.total_inserted
+        write_index = len(new.pi.writes)
+        new.pi.replay(device.pin, note["ticks"], speed or None)
+        last_edge_time = time.monotonic()
+
+        enabled = new.pi.wait_for_write(device.en_pin, 1, write_index, timeout=new.SETTLE_TIME + 5)
+        latency = enabled[1] - last_edge_time if enabled else None
+        results.append((note["nominal"], device.total_inserted - before, latency))
+    return results
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def print_report(results, label):
+    labelled = [(expected, credited) for expected, credited, _ in results if expected is not None]
+    correct = sum(1 for expected, credited in labelled if expected == credited)
+    latencies = [latency * 1000 for _, _, latency in results if latency is not None]
+
+    print(f"Mode: {label}")
+    print(f"Lembar: {len(results)}, berlabel: {len(labelled)}, benar: {correct}")
+    if labelled:
+        print(f"Akurasi decode: {100 * correct / len(labelled):.2f}%")
+    for index, (expected, credited, _) in enumerate(results):
+        if expected is not None and expected != credited:
+            print(f"  #{index}: diharapkan Rp.{expected}, terbaca Rp.{credited}")
+    if latencies:
+        print(f"Latensi (ms): p50 {percentile(latencies, 0.5):.2f}, p95 {percentile(latencies, 0.95):.2f}, maks {max(latencies):.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay rekaman pulsa bill acceptor ke logika decode.")
+    parser.add_argument("trace", help="korpus JSON lines: {\"nominal\": 5000, \"ticks\": [...]} per lembar, atau ekspor .npy")
+    parser.add_argument("--device", help="device_id yang dipakai (default: perangkat pertama)")
+    parser.add_argument("--realtime", action="store_true", help="replay lewat callback dan driver state machine")
+    parser.add_argument("--speed", type=float, default=1.0, help="kecepatan replay realtime (0 = tanpa jeda)")
+    args = parser.parse_args()
+
+    device = new.find_device(args.device) or next(iter(new.devices.values()))
+    notes = gpio_sim.load_trace(args.trace, int(new.train_end_threshold(device.gap_multiple, device.pulse_gap) * 1_000_000))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.realtime:
+            results = replay_realtime(device, notes, args.speed)
+        else:
+            results = replay_decode(device, notes)
+
+    print_report(results, "realtime" if args.realtime else "decode")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
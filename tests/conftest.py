@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# new.py dijalankan dengan backend GPIO simulasi dan direktori sementara, sama seperti replay.py/benchmark.py
+os.environ["BILL_GPIO_BACKEND"] = "sim"
+os.environ.setdefault("BILL_LOG_DIR", tempfile.mkdtemp(prefix="billacceptor-log-"))
+os.environ.setdefault("BILL_DATA_DIR", tempfile.mkdtemp(prefix="billacceptor-data-"))
+os.environ.setdefault("BILL_DENOMINATION_FILE", os.path.join(os.environ["BILL_DATA_DIR"], "denominations.json"))
+os.environ.setdefault("BILL_DEVICE_FILE", os.path.join(os.environ["BILL_DATA_DIR"], "devices.json"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
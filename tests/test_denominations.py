@@ -0,0 +1,58 @@
+import pytest
+
+import new
+
+# Perilaku closest_valid_pulse sebelum tabel denominasi dikompilasi (PULSE_MAPPING + TOLERANCE = 2)
+LEGACY_PULSES = (1, 2, 5, 10, 20, 50, 100)
+LEGACY_TOLERANCE = 2
+
+def legacy_closest_valid_pulse(pulses):
+    if pulses == 1:
+        return 1
+    if 2 < pulses < 5:
+        return 2
+    closest_pulse = min(LEGACY_PULSES, key=lambda x: abs(x - pulses) if x != 1 else float("inf"))
+    return closest_pulse if abs(closest_pulse - pulses) <= LEGACY_TOLERANCE else None
+
+@pytest.mark.parametrize("pulses", range(1, 151))
+def test_default_table_matches_legacy_decoder(pulses):
+    corrected, nominal, reason = new.decode_pulses(pulses)
+    assert corrected == legacy_closest_valid_pulse(pulses)
+    if corrected is None:
+        assert nominal == 0 and reason
+    else:
+        assert nominal == corrected * 1000 and reason is None
+
+def test_zero_pulses_rejected():
+    assert new.decode_pulses(0) == (None, 0, "tidak ada pulsa")
+
+def test_tolerance_form():
+    lookup = new.compile_denominations([
+        {"pulses": 5, "nominal": 5000, "tolerance": 2},
+        {"pulses": 10, "nominal": 10000, "tolerance": 1}
+    ])
+    assert [lookup[raw][0] for raw in range(1, 12)] == [None, None, 5, 5, 5, 5, 5, None, 10, 10, 10]
+    assert lookup[7] == (5, 5000, None)
+    assert lookup[8] == (None, 0, "di luar toleransi")
+    assert len(lookup) == 12
+
+def test_min_max_overrides_tolerance():
+    lookup = new.compile_denominations([{"pulses": 5, "nominal": 5000, "tolerance": 3, "min": 5, "max": 6}])
+    assert [lookup[raw][0] for raw in range(1, 7)] == [None, None, None, None, 5, 5]
+
+def test_overlapping_windows_rejected():
+    with pytest.raises(ValueError, match="tumpang tindih"):
+        new.compile_denominations([
+            {"pulses": 5, "nominal": 5000, "tolerance": 2},
+            {"pulses": 8, "nominal": 8000, "tolerance": 1}
+        ])
+
+@pytest.mark.parametrize("note", [
+    {"pulses": 5, "nominal": 5000, "min": 6, "max": 7},
+    {"pulses": 5, "nominal": 5000, "min": 3, "max": 4},
+    {"pulses": 2, "nominal": 2000, "tolerance": 2},
+    {"pulses": 0, "nominal": 0}
+])
+def test_invalid_windows_rejected(note):
+    with pytest.raises(ValueError, match="tidak valid"):
+        new.compile_denominations([note])